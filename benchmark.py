@@ -0,0 +1,230 @@
+import sys
+import os
+import json
+import time
+import platform
+import tracemalloc
+import numpy as np
+import pandas as pd
+from argparse import ArgumentParser
+from recommender import Database, User, Recommender, CACHE_DIRNAME
+
+#the catalog sizes measured by default
+DEFAULT_SIZES = (10000, 100000, 1000000)
+#differences below these are treated as noise rather than regressions
+MIN_SECONDS = 0.001
+MIN_PEAK_MB = 1.0
+#the share of generated rows that keep the title of their template row, so clean_data has duplicates to drop
+DUPLICATE_FRACTION = 0.05
+
+
+def generate_catalog(template_path, rows, filepath, seed=0, duplicate_fraction=DUPLICATE_FRACTION):
+    """Write a synthetic catalog shaped like titles.csv by resampling its rows, so benchmarks run offline at any size.
+
+    Every sampled row gets a unique id and its IMDb score is jittered. Most rows also get a unique title, while a sampled share keeps the template's title, so clean_data has duplicate titles to drop. Missing values of the template are kept too, so the catalog exercises all the cleaning of clean_data.
+
+    Args:
+        template_path (str): the path to a CSV file like titles.csv.
+        rows (int): the number of rows of the catalog.
+        filepath (str): the path the catalog is written to.
+        seed (int): the seed of the random sampling, so a size always gives the same catalog.
+        duplicate_fraction (float): the share of rows that keep the title of their template row.
+
+    Side effects:
+        Writes the CSV file.
+    """
+    template = pd.read_csv(template_path)
+    rng = np.random.default_rng(seed)
+    catalog = template.iloc[rng.integers(0, len(template), rows)].reset_index(drop=True)
+    suffix = pd.Series(np.arange(rows).astype(str))
+    catalog['id'] = catalog['id'] + "-" + suffix
+    unique_titles = rng.random(rows) >= duplicate_fraction
+    catalog.loc[unique_titles, 'title'] = catalog['title'][unique_titles] + " #" + suffix[unique_titles]
+    catalog['imdb_score'] = (catalog['imdb_score'] + rng.normal(0, 0.5, rows)).clip(1, 10).round(1)
+    catalog.to_csv(filepath, index=False)
+
+
+def catalog_path(template_path, rows, data_dir, seed=0):
+    """Get the path of a synthetic catalog, generating it the first time it is needed.
+
+    Args:
+        template_path (str): see generate_catalog.
+        rows (int): see generate_catalog.
+        data_dir (str): the directory the catalogs are kept in.
+        seed (int): see generate_catalog.
+
+    Return:
+        str: the path to the catalog.
+    """
+    #the share of duplicates is part of the name, so catalogs generated before it was added are not reused
+    filepath = os.path.join(data_dir, f"catalog.{rows}.{seed}.{DUPLICATE_FRACTION}.csv")
+    if not os.path.exists(filepath):
+        os.makedirs(data_dir, exist_ok=True)
+        generate_catalog(template_path, rows, filepath + ".tmp", seed)
+        os.replace(filepath + ".tmp", filepath)
+    return filepath
+
+
+def measure(function, repeat):
+    """Time a stage and measure its peak memory. Tracing allocations slows Python code down, so the peak comes from a separate run.
+
+    Args:
+        function (callable): runs the stage once.
+        repeat (int): the number of timed runs, of which the fastest is kept.
+
+    Return:
+        dict: the fastest time in seconds and the peak memory allocated during a run in megabytes.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(timings), "peak_mb": peak / 2**20}
+
+
+def benchmark_catalog(filepath, repeat=3, num_lookups=200):
+    """Measure the hot paths of the recommender system on one catalog.
+
+    Args:
+        filepath (str): the path to the catalog.
+        repeat (int): see measure.
+        num_lookups (int): the number of titles looked up, added to preferences and recommended from per run.
+
+    Return:
+        dict: the time and peak memory of every stage, see measure, keyed by stage.
+    """
+    results = {}
+    loader = Database.__new__(Database)
+    raw_df = loader.load_movie_data(filepath)
+    results["load_movie_data"] = measure(lambda: loader.load_movie_data(filepath), repeat)
+    results["clean_data"] = measure(lambda: loader.clean_data(raw_df.copy()), repeat)
+    loader.movies = loader.clean_data(raw_df.copy())
+    results["build_indexes"] = measure(loader.build_indexes, repeat)
+    results["init_uncached"] = measure(lambda: Database(filepath, use_cache=False), repeat)
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), CACHE_DIRNAME)
+    Database(filepath, cache_dir)
+    results["init_cached"] = measure(lambda: Database(filepath, cache_dir), repeat)
+
+    database = Database(filepath, cache_dir)
+    titles = database.movies['title'].iloc[np.linspace(0, len(database.movies) - 1, num_lookups).astype(int)].tolist()
+    #lowercase fragments exercise the substring search, and a missing title the worst case
+    queries = [title[1:-1].lower() for title in titles] + ["no such title"]
+    results["find_movie"] = measure(lambda: [database.find_movie(query) for query in queries], repeat)
+
+    def add_preferences():
+        user = User("benchmark")
+        for title in titles:
+            user.add_preference(title, database)
+        return user
+    results["add_preference"] = measure(add_preferences, repeat)
+
+    half = len(titles) // 2
+    user, friend = User("user"), User("friend")
+    for title in titles[:half]:
+        user.add_preference(title, database)
+    for title in titles[half:]:
+        friend.add_preference(title, database)
+    recommender = Recommender(user, friend)
+
+    def get_recommendation():
+        #clear the cached ranking so the whole catalog is scored
+        database.recommendation_cache.clear()
+        return recommender.get_recommendation(database)
+    results["get_recommendation"] = measure(get_recommendation, repeat)
+
+    def get_top_k():
+        database.recommendation_cache.clear()
+        return recommender.get_top_k(database, 10, "combined")
+    results["get_top_k"] = measure(get_top_k, repeat)
+    return results
+
+
+def run_benchmarks(template_path, sizes, data_dir, repeat=3):
+    """Measure every stage on a synthetic catalog of each size.
+
+    Args:
+        template_path (str): see generate_catalog.
+        sizes (list): the numbers of rows of the catalogs.
+        data_dir (str): see catalog_path.
+        repeat (int): see measure.
+
+    Return:
+        dict: the machine the benchmarks ran on and the results of benchmark_catalog keyed by catalog size.
+    """
+    results = {}
+    for rows in sizes:
+        results[str(rows)] = benchmark_catalog(catalog_path(template_path, rows, data_dir), repeat)
+    return {"machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}, "results": results}
+
+
+def compare_results(results, baseline, threshold=0.25):
+    """Find the stages that got slower or used more memory than in the baseline by more than the threshold.
+
+    Args:
+        results (dict): the output of run_benchmarks.
+        baseline (dict): an earlier output of run_benchmarks.
+        threshold (float): the accepted increase, as a fraction of the baseline.
+
+    Return:
+        list: a description of every regression. Stages or sizes missing from the baseline are not compared.
+    """
+    regressions = []
+    for rows, stages in results["results"].items():
+        for stage, measured in stages.items():
+            expected = baseline["results"].get(rows, {}).get(stage)
+            if expected is None:
+                continue
+            for metric, noise in (("seconds", MIN_SECONDS), ("peak_mb", MIN_PEAK_MB)):
+                limit = expected[metric] * (1 + threshold)
+                if measured[metric] > limit and measured[metric] - expected[metric] > noise:
+                    regressions.append(f"{stage} on {rows} rows: {metric} went from {expected[metric]:.4f} to {measured[metric]:.4f}")
+    return regressions
+
+
+def parse_args(arglist):
+    """Takes a list of strings from the command prompt and passes them through as arguments
+
+    Args:
+        arglist (list): the list of strings from the command prompt
+
+    Returns:
+        args (ArgumentParser)
+    """
+    parser = ArgumentParser(description="Benchmark loading, cleaning, lookups and recommendations on synthetic catalogs shaped like titles.csv.")
+    parser.add_argument("--template", type=str, default="titles.csv", help="CSV file the synthetic catalogs are sampled from")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="numbers of rows of the catalogs")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage, of which the fastest is kept")
+    parser.add_argument("--data-dir", type=str, default=os.path.join(CACHE_DIRNAME, "benchmark"), help="directory the generated catalogs are kept in")
+    parser.add_argument("--baseline", type=str, default="benchmark_baseline.json", help="JSON file of the baseline results")
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline instead of comparing against it")
+    parser.add_argument("--threshold", type=float, default=0.25, help="accepted increase of time or peak memory over the baseline, as a fraction")
+    parser.add_argument("--output", type=str, default="-", help="file to write the results to as JSON (default: stdout)")
+    return parser.parse_args(arglist)
+
+if __name__ == "__main__":
+    arguments = parse_args(sys.argv[1:])
+    report = run_benchmarks(arguments.template, arguments.sizes, arguments.data_dir, arguments.repeat)
+    if arguments.output == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        with open(arguments.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if arguments.save:
+        with open(arguments.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+    elif os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as f:
+            regressions = compare_results(report, json.load(f), arguments.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,146 @@
+import sys
+import json
+import math
+import time
+import asyncio
+from urllib.parse import quote
+from argparse import ArgumentParser
+
+#the users created before the load starts, and the titles added to their preferences
+SEED_USERS = {"loadgen-a": ["Arcane", "Taxi Driver", "Breaking Bad"], "loadgen-b": ["Taxi Driver", "Stranger Things"], "loadgen-c": ["Arcane", "Okupas"]}
+
+
+class Connection():
+    """A keep-alive HTTP/1.1 connection to the recommendation service.
+
+    Attributes:
+        reader (StreamReader): the incoming side of the connection.
+        writer (StreamWriter): the outgoing side of the connection.
+    """
+    def __init__(self, reader, writer):
+        """Initializes a Connection class.
+
+        Args:
+            reader (StreamReader): see class documentation.
+            writer (StreamWriter): see class documentation.
+        """
+        self.reader = reader
+        self.writer = writer
+
+    async def request(self, method, path, payload=None):
+        """Send a request and wait for the whole response.
+
+        Args:
+            method (str): the HTTP method.
+            path (str): the request target.
+            payload (dict): an optional JSON body.
+
+        Return:
+            tuple: the status code and the decoded JSON response.
+        """
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: loadgen\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        return status, json.loads(await self.reader.readexactly(length))
+
+    def close(self):
+        """Close the connection.
+
+        Side effects:
+            Closes the underlying socket.
+        """
+        self.writer.close()
+
+
+def percentile(latencies, percent):
+    """Get a percentile of sorted latencies using the nearest rank.
+
+    Args:
+        latencies (list): the latencies in ascending order.
+        percent (float): the percentile, between 0 and 100.
+
+    Return:
+        float: the latency at that percentile.
+    """
+    rank = max(math.ceil(percent / 100 * len(latencies)) - 1, 0)
+    return latencies[rank]
+
+
+async def run_load(host, port, total, concurrency, paths):
+    """Seed the service with users and send requests from several concurrent connections.
+
+    Args:
+        host (str): the address of the service.
+        port (int): the port of the service.
+        total (int): the number of requests to send.
+        concurrency (int): the number of connections sending requests at the same time.
+        paths (list): the request targets, sent in turn.
+
+    Return:
+        dict: the number of requests, errors, throughput and p50/p99 latencies in milliseconds.
+    """
+    seed = Connection(*await asyncio.open_connection(host, port))
+    for name, titles in SEED_USERS.items():
+        for title in titles:
+            await seed.request("POST", f"/users/{quote(name)}/preferences", {"title": title})
+    seed.close()
+
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        connection = Connection(*await asyncio.open_connection(host, port))
+        for number in counter:
+            start = time.perf_counter()
+            status, _ = await connection.request("GET", paths[number % len(paths)])
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+        connection.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {"requests": len(latencies), "errors": errors, "requests_per_second": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000, "p99_ms": percentile(latencies, 99) * 1000}
+
+
+def parse_args(arglist):
+    """Takes a list of strings from the command prompt and passes them through as arguments
+
+    Args:
+        arglist (list): the list of strings from the command prompt
+
+    Returns:
+        args (ArgumentParser)
+    """
+    names = ",".join(SEED_USERS)
+    parser = ArgumentParser(description="Generate load against a running recommendation service and report latency percentiles.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address of the service")
+    parser.add_argument("--port", type=int, default=8080, help="port of the service")
+    parser.add_argument("--requests", type=int, default=2000, help="total number of requests to send")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of concurrent connections")
+    parser.add_argument("--path", action="append", default=None, help="request target to send, repeat to mix several (default: recommendations and searches)")
+    args = parser.parse_args(arglist)
+    if args.path is None:
+        args.path = [f"/recommendations?users={names}&k=10", f"/recommendations?users={names}&k=10&policy=weighted&sort=combined", "/search?q=taxi"]
+    return args
+
+if __name__ == "__main__":
+    arguments = parse_args(sys.argv[1:])
+    report = asyncio.run(run_load(arguments.host, arguments.port, arguments.requests, arguments.concurrency, arguments.path))
+    print(json.dumps(report, indent=2))
@@ -1,24 +1,1194 @@
 import sys
+import os
 import re
+import json
+import pickle
+import csv
+import math
+import time
+import hashlib
+import threading
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+import multiprocessing
+from collections import OrderedDict
+from bisect import bisect_left
+import numpy as np
 import pandas as pd
 from argparse import ArgumentParser
 
+#bump whenever the cleaned data or the derived indexes change shape, so stale caches are rebuilt
+CACHE_VERSION = 7
+CACHE_DIRNAME = ".recommender_cache"
+#the ways recommendations can be ranked
+SORT_ORDERS = ("matches", "score", "combined")
+#the columns of a recommendation written out by the batch pipeline
+RESULT_COLUMNS = ["id", "title", "type", "age_certification", "imdb_score"]
+#the memory the cached positions of filtered media may use per Database
+FILTER_CACHE_BYTES = 8 * 2**20
+
+#the words of a description that are turned into TF-IDF features, and the common words left out
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset("""a an and are as at be but by for from has have he her his in into is it its of on or she that the their them they this to was were when where which while who will with""".split())
+
+#the environment variables that turn on instrumentation, name the file metrics are exported to and pick a profiler
+INSTRUMENT_ENV = "RECOMMENDER_INSTRUMENT"
+METRICS_ENV = "RECOMMENDER_METRICS"
+PROFILE_ENV = "RECOMMENDER_PROFILE"
+PROFILERS = ("cprofile", "tracemalloc")
+
+#the read-only Database and users shared by the batch worker processes, set once per process by init_batch_worker
+batch_worker = {}
+
+
+def library_versions():
+    """Get the versions of the libraries whose pickles the binary cache holds.
+
+    Return:
+        dict: the pandas and NumPy versions.
+    """
+    return {"pandas": pd.__version__, "numpy": np.__version__}
+
+
+def file_digest(filepath):
+    """Compute the SHA-256 hash of a file without reading it into memory all at once.
+
+    Args:
+        filepath (str): the path to the file.
+
+    Return:
+        str: the hexadecimal digest of the file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_genres(genres):
+    """Split a raw genres string such as "['drama', 'crime']" into a list of genre names.
+
+    Args:
+        genres (str): the genres value as stored in the dataset.
+
+    Return:
+        list: the genre names in their original order (empty if the value is missing).
+    """
+    if not isinstance(genres, str):
+        return []
+    genre_list = [genre.strip().strip("'") for genre in genres.strip('][').split(',')]
+    return [genre for genre in genre_list if genre]
+
+
+def top_k_positions(keys, k):
+    """Select the positions of the k largest keys without sorting every key.
+
+    Args:
+        keys (ndarray): the ranking key of each candidate, larger is better.
+        k (int): the number of positions to select.
+
+    Return:
+        ndarray: up to k positions into keys, best first. Equal keys keep their original order.
+    """
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    if k < len(keys):
+        #partial selection finds the k-th largest key in linear time
+        threshold = np.partition(keys, len(keys) - k)[len(keys) - k]
+        above = np.flatnonzero(keys > threshold)
+        #keys tied with the k-th largest are taken in their original order, like a stable sort would
+        tied = np.flatnonzero(keys == threshold)[:k - len(above)]
+        chosen = np.concatenate([above, tied])
+    else:
+        chosen = np.arange(len(keys))
+    return chosen[np.lexsort((chosen, -keys[chosen]))]
+
+
+def spread_rows(indptr, rows):
+    """Get the positions of the values of some rows of a CSR sparse matrix, row after row.
+
+    Args:
+        indptr (ndarray): where the values of each row start, as in a CSR sparse matrix.
+        rows (ndarray): the rows.
+
+    Return:
+        ndarray: the positions of every value of the rows, in the order of rows.
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    #the offset of each value within its row, counted from the running total of the lengths
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
+
+
+class Instrumentation():
+    """Per-stage timers and counters of the hot paths, which cost a shared no-op context manager per stage when disabled.
+
+    Attributes:
+        enabled (bool): whether stages are timed and counters kept.
+        timings (dict): the number of calls, total seconds and slowest call of every stage, keyed by stage.
+        counters (dict): counts such as rows scanned, candidates ranked and cache hits, keyed by name.
+        lock (Lock): guards timings and counters, since the HTTP service and batch threads share them.
+    """
+    def __init__(self, enabled=False):
+        """Initializes an Instrumentation class.
+
+        Args:
+            enabled (bool): see class documentation.
+        """
+        self.enabled = enabled
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        """Create the instrumentation, enabled when the RECOMMENDER_INSTRUMENT or RECOMMENDER_METRICS environment variable is set.
+
+        Return:
+            Instrumentation: the instrumentation.
+        """
+        enabled = os.environ.get(INSTRUMENT_ENV, "") not in ("", "0") or bool(os.environ.get(METRICS_ENV))
+        return cls(enabled)
+
+    def stage(self, name):
+        """Time a stage of the work.
+
+        Args:
+            name (str): the name of the stage.
+
+        Return:
+            a context manager timing the code it wraps.
+        """
+        if not self.enabled:
+            return NO_STAGE
+        return self.timed(name)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """Time the wrapped code and add it to the stage's timings.
+
+        Args:
+            name (str): the name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                calls, total, slowest = self.timings.get(name, (0, 0.0, 0.0))
+                self.timings[name] = (calls + 1, total + elapsed, max(slowest, elapsed))
+
+    def count(self, name, amount=1):
+        """Add to a counter.
+
+        Args:
+            name (str): the name of the counter.
+            amount (int): how much to add.
+        """
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + int(amount)
+
+    def reset(self):
+        """Forget every timing and counter.
+
+        Side effects:
+            Empties timings and counters.
+        """
+        with self.lock:
+            self.timings.clear()
+            self.counters.clear()
+
+    def snapshot(self):
+        """Get the current timings and counters as a structured record.
+
+        Return:
+            dict: the time of the snapshot, the timings of every stage and the counters.
+        """
+        with self.lock:
+            return self.record(self.timings, self.counters)
+
+    def record(self, timings, counters):
+        """Format timings and counters as a structured record.
+
+        Args:
+            timings (dict): see class documentation.
+            counters (dict): see class documentation.
+
+        Return:
+            dict: see snapshot.
+        """
+        timings = {name: {"calls": calls, "seconds": total, "max_seconds": slowest} for name, (calls, total, slowest) in sorted(timings.items())}
+        return {"time": time.time(), "pid": os.getpid(), "timings": timings, "counters": dict(sorted(counters.items()))}
+
+    def drain(self):
+        """Take the timings and counters gathered since the last drain, such as in a worker process reporting to its parent.
+
+        Return:
+            dict: see snapshot, or None while disabled.
+
+        Side effects:
+            Empties timings and counters.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            timings, counters = self.timings, self.counters
+            self.timings, self.counters = {}, {}
+        return self.record(timings, counters)
+
+    def merge(self, record):
+        """Add the timings and counters of a record, such as one drained by a worker process.
+
+        Args:
+            record (dict): see snapshot, or None to merge nothing.
+        """
+        if record is None:
+            return
+        with self.lock:
+            for name, timing in record["timings"].items():
+                calls, total, slowest = self.timings.get(name, (0, 0.0, 0.0))
+                self.timings[name] = (calls + timing["calls"], total + timing["seconds"], max(slowest, timing["max_seconds"]))
+            for name, value in record["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_prometheus(self):
+        """Format the timings and counters in the Prometheus text exposition format.
+
+        Return:
+            str: the metrics, one sample per line.
+        """
+        record = self.snapshot()
+        lines = ["# TYPE recommender_stage_calls_total counter"]
+        lines += [f'recommender_stage_calls_total{{stage="{name}"}} {timing["calls"]}' for name, timing in record["timings"].items()]
+        lines.append("# TYPE recommender_stage_seconds_total counter")
+        lines += [f'recommender_stage_seconds_total{{stage="{name}"}} {timing["seconds"]:.9f}' for name, timing in record["timings"].items()]
+        lines.append("# TYPE recommender_stage_max_seconds gauge")
+        lines += [f'recommender_stage_max_seconds{{stage="{name}"}} {timing["max_seconds"]:.9f}' for name, timing in record["timings"].items()]
+        for name, value in record["counters"].items():
+            lines += [f"# TYPE recommender_{name}_total counter", f"recommender_{name}_total {value}"]
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Export the metrics to a file: a Prometheus text file when the path ends in .prom, and otherwise a JSON line appended to a structured log.
+
+        Args:
+            path (str): the file to export to.
+
+        Side effects:
+            Replaces the Prometheus text file, or appends to the log.
+        """
+        if path.endswith(".prom"):
+            #write then rename, so a scraper never reads a half written file
+            with open(path + ".tmp", "w") as f:
+                f.write(self.to_prometheus())
+            os.replace(path + ".tmp", path)
+        else:
+            with open(path, "a") as f:
+                f.write(json.dumps(self.snapshot()) + "\n")
+
+    @contextlib.contextmanager
+    def profile(self, profiler, path=None):
+        """Profile the wrapped code with cProfile or tracemalloc.
+
+        Args:
+            profiler (str): "cprofile", "tracemalloc", or None to not profile.
+            path (str): the file the cProfile statistics are dumped to or the tracemalloc report is written to. Defaults to a report on stderr.
+
+        Side effects:
+            Writes the profile once the wrapped code finishes.
+
+        Raises:
+            ValueError: profiler is not one of PROFILERS.
+        """
+        if profiler is None:
+            yield
+            return
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler \"{profiler}\". Expected one of {PROFILERS}.")
+        if profiler == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                if path is not None:
+                    profile.dump_stats(path)
+                else:
+                    pstats.Stats(profile, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
+            return
+
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report = [f"peak traced memory: {peak / 2**20:.1f} MB"] + [str(stat) for stat in snapshot.statistics("lineno")[:25]]
+            if path is not None:
+                with open(path, "w") as f:
+                    f.write("\n".join(report) + "\n")
+            else:
+                print("\n".join(report), file=sys.stderr)
+
+#the context manager of every stage while instrumentation is disabled
+NO_STAGE = contextlib.nullcontext()
+#the instrumentation of this process, see Instrumentation.from_environment
+instrumentation = Instrumentation.from_environment()
+
+
+class TitleIndex():
+    """A lookup index over the titles of the database.
+
+    Attributes:
+        titles (list): the lowercase titles, in the same order as the database rows.
+        exact (dict): maps each lowercase title to the position of its first occurrence.
+        sorted_titles (list): the lowercase titles in alphabetical order, for prefix searches.
+        sorted_positions (ndarray): the row position of each title in sorted_titles.
+        trigrams (dict): maps every three character sequence to the sorted positions of the titles containing it.
+        short_substrings (dict): maps every one and two character sequence to the position of the first title containing it, which answers queries too short for a trigram.
+    """
+    modes = ("substring", "prefix", "exact")
+
+    def __init__(self, titles):
+        """Initializes a TitleIndex class.
+
+        Args:
+            titles (Series): the titles column of the database.
+        """
+        self.titles = [str(title).lower() for title in titles]
+        self.exact = {}
+        trigrams = {}
+        for position, title in enumerate(self.titles):
+            self.exact.setdefault(title, position)
+            for trigram in {title[i:i + 3] for i in range(len(title) - 2)}:
+                trigrams.setdefault(trigram, []).append(position)
+        self.trigrams = {trigram: np.array(positions, dtype=np.int64) for trigram, positions in trigrams.items()}
+
+        #every shorter sequence of a title with a trigram is part of one, so the first title containing it is the first of those trigrams
+        firsts = [(positions[0], (trigram[0], trigram[1], trigram[2], trigram[:2], trigram[1:])) for trigram, positions in trigrams.items()]
+        firsts += [(position, set(title).union(title[i:i + 2] for i in range(len(title) - 1))) for position, title in enumerate(self.titles) if len(title) < 3]
+        self.short_substrings = {}
+        for position, sequences in firsts:
+            for sequence in sequences:
+                if position < self.short_substrings.get(sequence, len(self.titles)):
+                    self.short_substrings[sequence] = position
+
+        order = sorted(range(len(self.titles)), key=self.titles.__getitem__)
+        self.sorted_titles = [self.titles[position] for position in order]
+        self.sorted_positions = np.array(order, dtype=np.int64)
+
+    @classmethod
+    def from_state(cls, state):
+        """Recreate a TitleIndex from the plain data of its attributes, as stored by the binary cache.
+
+        Args:
+            state (dict): the attributes of a TitleIndex, see vars.
+
+        Return:
+            TitleIndex: the index, without building it again.
+        """
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        return index
+
+    def lookup(self, query, mode="substring"):
+        """Find the first title matching the query, ignoring case.
+
+        Args:
+            query (str): the title, or part of the title, to look for.
+            mode (str): "substring" for the first title containing the query, "prefix" for the first title starting with it, or "exact" for the title equal to it.
+
+        Return:
+            int: the row position of the matching title, or None if there is no match.
+
+        Raises:
+            ValueError: the mode is not one of the supported modes.
+        """
+        query = query.lower()
+        if mode == "exact":
+            return self.exact.get(query)
+        elif mode == "prefix":
+            return self.lookup_prefix(query)
+        elif mode == "substring":
+            return self.lookup_substring(query)
+        raise ValueError(f"Unknown title search mode \"{mode}\". Expected one of {self.modes}.")
+
+    def lookup_prefix(self, query):
+        """Find the first title starting with a lowercase query using the sorted titles.
+
+        Args:
+            query (str): the lowercase prefix.
+
+        Return:
+            int: the row position of the matching title, or None if there is no match.
+        """
+        start = bisect_left(self.sorted_titles, query)
+        if query:
+            #every title with the prefix sorts before the prefix with its last character bumped
+            end = bisect_left(self.sorted_titles, query[:-1] + chr(ord(query[-1]) + 1), lo=start)
+        else:
+            end = len(self.sorted_titles)
+        if end == start:
+            return None
+        return int(self.sorted_positions[start:end].min())
+
+    def lookup_substring(self, query):
+        """Find the first title containing a lowercase query using the trigram postings.
+
+        Args:
+            query (str): the lowercase substring.
+
+        Return:
+            int: the row position of the matching title, or None if there is no match.
+        """
+        if not query:
+            return 0 if self.titles else None
+        if len(query) < 3:
+            #too short for a trigram, so the first title containing it was recorded while building
+            return self.short_substrings.get(query)
+
+        postings = []
+        for trigram in {query[i:i + 3] for i in range(len(query) - 2)}:
+            if trigram not in self.trigrams:
+                return None
+            postings.append(self.trigrams[trigram])
+        postings.sort(key=len)
+
+        #intersect from the rarest trigram, then confirm the candidates in row order
+        candidates = postings[0]
+        for positions in postings[1:3]:
+            candidates = np.intersect1d(candidates, positions, assume_unique=True)
+        for position in candidates:
+            if query in self.titles[position]:
+                return int(position)
+        return None
+
+
+class RecommendationCache():
+    """A bounded least recently used cache of ranked recommendations, with optional expiry.
+
+    Entries are tuples of NumPy arrays (such as the ranked row positions and their matches) keyed on the normalized genre signature of a request, and the cache is bounded by the total size of those arrays.
+
+    Attributes:
+        max_bytes (int): the most memory the cached arrays may use.
+        ttl (float): the number of seconds an entry stays valid, or None to keep entries until they are evicted.
+        entries (OrderedDict): the cached entries from least to most recently used, each with its expiry time and size.
+        nbytes (int): the memory used by the cached arrays.
+        hits (int): the number of lookups answered from the cache.
+        misses (int): the number of lookups not in the cache.
+        evictions (int): the number of entries removed to stay within max_bytes.
+        expirations (int): the number of entries dropped because they were older than ttl.
+        metric (str): the prefix of the hits and misses counters of the cache in instrumentation.
+    """
+    def __init__(self, max_bytes=64 * 2**20, ttl=None, metric="cache"):
+        """Initializes a RecommendationCache class.
+
+        Args:
+            max_bytes (int): see class documentation.
+            ttl (float): see class documentation.
+            metric (str): see class documentation.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.metric = metric
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Look up an entry and mark it as the most recently used.
+
+        Args:
+            key (tuple): the normalized signature of the request.
+
+        Return:
+            tuple: the cached arrays, or None if the key is not cached or has expired.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                self.remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                instrumentation.count(f"{self.metric}_misses")
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            instrumentation.count(f"{self.metric}_hits")
+            return entry[2]
+
+    def put(self, key, value):
+        """Cache an entry, evicting the least recently used entries until it fits.
+
+        Args:
+            key (tuple): the normalized signature of the request.
+            value (tuple): the arrays to cache.
+        """
+        size = sum(array.nbytes for array in value)
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            while self.entries and self.nbytes + size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+            self.entries[key] = (expires, size, value)
+            self.nbytes += size
+
+    def remove(self, key):
+        """Remove an entry. The caller must hold the lock.
+
+        Args:
+            key (tuple): the key of the entry.
+        """
+        self.nbytes -= self.entries.pop(key)[1]
+
+    def clear(self):
+        """Remove every entry, such as when the data it was computed from changes.
+
+        Side effects:
+            Empties entries. The counters are kept.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Get the counters of the cache.
+
+        Return:
+            dict: the number of entries, bytes used, hits, misses, evictions and expirations.
+        """
+        return {"entries": len(self.entries), "bytes": self.nbytes, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+
+class MediaFilter():
+    """Declarative conditions a media must meet to be recommended, applied before the catalog is scored.
+
+    Attributes:
+        media_types (tuple): the accepted types, such as "MOVIE" or "SHOW", or None to accept every type.
+        age_ratings (tuple): the accepted age certifications, where None stands for a missing certification, or None to accept every certification.
+        min_score (float): the lowest accepted IMDb score, or None.
+    """
+    def __init__(self, media_types=None, age_ratings=None, min_score=None):
+        """Initializes a MediaFilter class.
+
+        Args:
+            media_types (iterable): see class documentation.
+            age_ratings (iterable): see class documentation.
+            min_score (float): see class documentation.
+        """
+        self.media_types = tuple(sorted(set(media_types))) if media_types is not None else None
+        self.age_ratings = tuple(sorted(set(age_ratings), key=lambda rating: (rating is None, rating or ""))) if age_ratings is not None else None
+        self.min_score = float(min_score) if min_score is not None else None
+
+    @classmethod
+    def from_dict(cls, conditions):
+        """Create a MediaFilter from the filters of a JSON request, such as {"type": ["MOVIE"], "age_certification": ["PG", "PG-13"], "min_score": 7}.
+
+        Args:
+            conditions (dict): the filters, where a single type or certification may be given as a string. Missing keys accept everything.
+
+        Return:
+            MediaFilter: the filter, or None if conditions has no filters.
+
+        Raises:
+            ValueError: conditions has an unknown key.
+        """
+        if not conditions:
+            return None
+        unknown = set(conditions) - {"type", "age_certification", "min_score"}
+        if unknown:
+            raise ValueError(f"Unknown filters: {', '.join(sorted(unknown))}")
+        media_types, age_ratings = (conditions.get(name) for name in ("type", "age_certification"))
+        return cls([media_types] if isinstance(media_types, str) else media_types,
+                   [age_ratings] if isinstance(age_ratings, str) else age_ratings, conditions.get("min_score"))
+
+    def key(self):
+        """Get the normalized signature of the filter, which identifies its mask and the recommendations ranked with it.
+
+        Return:
+            tuple: the accepted types, age certifications and lowest score.
+        """
+        return (self.media_types, self.age_ratings, self.min_score)
+
+    def mask(self, database):
+        """Compute which media of a Database meet every condition.
+
+        Args:
+            database (Database): the Database to filter.
+
+        Return:
+            ndarray: a boolean array with one entry per row of movies.
+        """
+        mask = np.ones(len(database.imdb_scores), dtype=bool)
+        for name, accepted in (("type", self.media_types), ("age_certification", self.age_ratings)):
+            if accepted is not None:
+                #compare small integer codes rather than strings
+                values, codes = database.value_codes(name)
+                mask &= np.isin(codes, [code for code, value in enumerate(values) if value in accepted])
+        if self.min_score is not None:
+            mask &= database.imdb_scores >= self.min_score
+        return mask
+
+
+class NeighborTable():
+    """The precomputed most similar media of every media of a Database.
+
+    Attributes:
+        neighbors (ndarray): one row per media with the positions of its neighbors in the Database, most similar first, padded with -1.
+        scores (ndarray): the similarity of each neighbor.
+    """
+    def __init__(self, neighbors, scores):
+        """Initializes a NeighborTable class.
+
+        Args:
+            neighbors (ndarray): see class documentation.
+            scores (ndarray): see class documentation.
+        """
+        self.neighbors = neighbors
+        self.scores = scores
+
+    @classmethod
+    def build(cls, database, num_neighbors=20, score_weight=0.0, block_sets=None):
+        """Compute the neighbors of every media by the Jaccard similarity of their genres.
+
+        The similarity only depends on the genre sets, so it is computed between the distinct genre sets, a block of sets at a time. Within a genre set, media rank by IMDb score, so each set only offers its best num_neighbors + 1 media as candidates, and every media of a set shares the same ranked candidates apart from itself.
+
+        Args:
+            database (Database): the Database to compute the neighbors of.
+            num_neighbors (int): the number of neighbors kept per media.
+            score_weight (float): between 0 and 1, how much of the similarity comes from the neighbor's IMDb score (out of 10) instead of the genres.
+            block_sets (int): the number of genre sets compared to every other genre set at once. Defaults to keeping the float64 intermediates of a block around 64 MB.
+
+        Return:
+            NeighborTable: the neighbors. Media sharing no genre are never neighbors.
+        """
+        genre_sets = np.asarray(database.genre_set_matrix, dtype=np.float64)
+        set_codes = np.asarray(database.genre_set_codes)
+        imdb_scores = np.asarray(database.imdb_scores, dtype=np.float64)
+        num_rows, num_sets = len(set_codes), len(genre_sets)
+        width = max(min(num_neighbors, num_rows - 1), 0)
+        neighbors = np.full((num_rows, width), -1, dtype=np.int32)
+        scores = np.zeros((num_rows, width), dtype=np.float32)
+        if width == 0:
+            return cls(neighbors, scores)
+
+        #the rows of every genre set, best IMDb score first and then in row order
+        order = np.lexsort((np.arange(num_rows), -imdb_scores, set_codes))
+        set_starts = np.searchsorted(set_codes[order], np.arange(num_sets + 1))
+        rank_in_set = np.arange(num_rows) - set_starts[set_codes[order]]
+        #one more candidate than needed, in case a media finds itself among them
+        candidates = order[rank_in_set <= width]
+        candidate_sets = set_codes[candidates]
+        blended_scores = score_weight * imdb_scores[candidates] / 10
+        #a tiny share of the IMDb score breaks ties between equally similar media without changing the stored similarity
+        tie_breaker = imdb_scores[candidates] * 1e-6
+
+        set_totals = genre_sets.sum(axis=1)
+        #shared, union and jaccard are block_sets x num_sets float64 arrays
+        block_sets = block_sets or max(1, 2**23 // max(num_sets, 1) // 3)
+        for block_start in range(0, num_sets, block_sets):
+            block_end = min(block_start + block_sets, num_sets)
+            shared = genre_sets[block_start:block_end] @ genre_sets.T
+            union = set_totals[block_start:block_end, None] + set_totals[None, :] - shared
+            jaccard = np.divide(shared, union, out=np.zeros_like(shared), where=union > 0)
+            for code in range(block_start, block_end):
+                rows = order[set_starts[code]:set_starts[code + 1]]
+                if len(rows) == 0:
+                    continue
+                candidate_jaccard = jaccard[code - block_start][candidate_sets]
+                similarity = (1 - score_weight) * candidate_jaccard + blended_scores
+                keys = np.where(candidate_jaccard > 0, similarity + tie_breaker, -np.inf)
+                top = top_k_positions(keys, width + 1)
+                top = top[keys[top] > -np.inf]
+                top_rows = candidates[top]
+
+                #a media is not its own neighbor, so it is moved after the others and the last column is dropped
+                is_self = top_rows[None, :] == rows[:, None]
+                picked = np.argsort(is_self, axis=1, kind="stable")[:, :width]
+                found = min(width, len(top_rows))
+                valid = ~np.take_along_axis(is_self, picked, axis=1)[:, :found]
+                neighbors[rows, :found] = np.where(valid, top_rows[picked[:, :found]], -1)
+                scores[rows, :found] = np.where(valid, similarity[top][picked[:, :found]], 0)
+        return cls(neighbors, scores)
+
+    @classmethod
+    def load(cls, path):
+        """Open a saved neighbor table memory-mapped, so each lookup only reads one row from disk.
+
+        Args:
+            path (str): the path prefix the table was saved under.
+
+        Return:
+            NeighborTable: the neighbor table.
+        """
+        return cls(np.load(f"{path}.neighbors.npy", mmap_mode="r"), np.load(f"{path}.scores.npy", mmap_mode="r"))
+
+    def save(self, path, database):
+        """Save the neighbor table as two NumPy files.
+
+        Args:
+            path (str): the path prefix to save under.
+            database (Database): used to write the files atomically, see Database.write_cache_file.
+
+        Side effects:
+            Writes the files.
+        """
+        database.write_cache_file(f"{path}.scores.npy", lambda f: np.save(f, self.scores))
+        database.write_cache_file(f"{path}.neighbors.npy", lambda f: np.save(f, self.neighbors))
+
+    def lookup(self, row):
+        """Get the neighbors of a media.
+
+        Args:
+            row (int): the position of the media within the Database.
+
+        Return:
+            tuple: the positions of the neighbors, most similar first, and their similarity.
+        """
+        neighbors = np.asarray(self.neighbors[row])
+        found = neighbors >= 0
+        return neighbors[found], np.asarray(self.scores[row])[found]
+
 
 class Database():
     """A class for storing a dataframe of the dataset.
 
     Attributes:
         movies (DataFrame): dataframe containing the Neflix data.
+        genre_names (list): the sorted list of every genre in the dataset.
+        genre_codes (dict): maps each genre name to its column in genre_matrix and its bit in genre_masks.
+        genre_sets (list): every distinct list of genres in the dataset, parsed once.
+        genre_set_codes (ndarray): for each row of movies, the position of its genres in genre_sets.
+        genre_set_matrix (ndarray): a multi-hot uint8 matrix with one row per entry of genre_sets.
+        genre_matrix (ndarray): a multi-hot uint8 matrix with one row per media in movies and one column per genre in genre_names.
+        genre_masks (ndarray): a bitmask of the genres of each row of movies.
+        title_index (TitleIndex): the index used to look up titles.
+        imdb_scores (ndarray): the imdb_score column of movies as a float array.
+        description_indptr (ndarray): where the features of each row of movies start in description_indices and description_data, as in a CSR sparse matrix.
+        description_indices (ndarray): the feature (word) of each stored TF-IDF value.
+        description_counts (ndarray): the number of times the word of each stored TF-IDF value appears in its description.
+        description_data (ndarray): the stored TF-IDF values, so that every description vector has unit length.
+        description_rows (ndarray): the row of movies of each stored TF-IDF value.
+        description_features (int): the number of distinct words in the descriptions.
+        description_vocabulary (list): the word of each feature.
+        filepath (str): the filepath to the dataset.
+        cache_dir (str): the directory holding the binary cache of the cleaned data and its indexes.
+        recommendation_cache (RecommendationCache): ranked recommendations computed from this data, which are dropped with it.
+        filter_cache (RecommendationCache): the positions of the media passing each filter, kept apart so they neither evict recommendations nor count as their hits.
+        column_values (dict): the columns of movies already converted to NumPy arrays by column.
+        neighbor_tables (dict): the NeighborTable objects opened by get_neighbor_table, keyed by their settings.
+        column_codes (dict): the distinct values of columns of movies and the code of every row's value, by column.
+        id_index (tuple): the distinct ids of movies as an Index and the first row of each, once find_rows_by_id built them.
+        source_digest (str): the SHA-256 hash of the dataset, once known.
+        source_stat (tuple): the size and modification time of the dataset when it was loaded, which tells whether the file changed since.
+        changes (dict): when built from a previous snapshot, the number of rows added, changed, removed and whose description vectors were reused.
     """
-    def __init__(self, filepath):
-        """Initializes a Database class.
+    #identify the columns to include in the dataframe
+    columns = ["id", "title", "type", "description", "age_certification", "genres", "imdb_score"]
+    #derived indexes persisted by the binary cache, as memory-mapped arrays and pickled objects
+    cached_arrays = ["genre_set_codes", "genre_set_matrix", "genre_matrix", "genre_masks", "imdb_scores",
+                     "description_indptr", "description_indices", "description_counts", "description_data", "description_rows"]
+    cached_objects = ["genre_names", "genre_codes", "genre_sets", "title_index", "description_features", "description_vocabulary"]
+    #cached objects that are stored as the plain data of their attributes, so the cache does not depend on the module that wrote it (such as __main__)
+    cached_states = {"title_index": TitleIndex}
+
+    def __init__(self, filepath, cache_dir=None, use_cache=True, chunksize=None, previous=None):
+        """Initializes a Database class. The cleaned data is loaded from the binary cache when the cache matches the dataset, and is otherwise rebuilt from the CSV file and cached.
 
         Args: 
             filepath (str): the filepath to the dataset.
+            cache_dir (str): see class documentation. Defaults to a directory next to the dataset.
+            use_cache (bool): whether to read and write the binary cache.
+            chunksize (int): if given, the CSV file is loaded and cleaned this many rows at a time, so the raw data is never held all at once (see stream_movie_data). Building the indexes afterwards still needs memory in proportion to the whole dataset.
+            previous (Database): an older snapshot of the catalog, whose description word counts are reused for the rows whose description did not change, and whose indexes are shared when no row changed. It is only read, so it can keep serving requests meanwhile.
         """
-        self.movies = self.load_movie_data(filepath)
-        self.movies = self.clean_data(self.movies)
-        
+        self.filepath = filepath
+        self.recommendation_cache = RecommendationCache()
+        self.filter_cache = RecommendationCache(max_bytes=FILTER_CACHE_BYTES, metric="filter_cache")
+        self.column_values = {}
+        self.neighbor_tables = {}
+        self.column_codes = {}
+        self.id_index = None
+        self.source_digest = None
+        self.changes = None
+        stat = os.stat(filepath)
+        self.source_stat = (stat.st_size, stat.st_mtime_ns)
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), CACHE_DIRNAME)
+        self.cache_dir = cache_dir
+
+        if use_cache:
+            with instrumentation.stage("load_cache"):
+                loaded = self.load_cache()
+            if loaded:
+                instrumentation.count("rows_loaded", len(self.movies))
+                return
+        if chunksize is not None:
+            with instrumentation.stage("stream_movie_data"):
+                self.movies = self.stream_movie_data(filepath, chunksize)
+        else:
+            with instrumentation.stage("load_movie_data"):
+                self.movies = self.load_movie_data(filepath)
+            with instrumentation.stage("clean_data"):
+                self.movies = self.clean_data(self.movies)
+        instrumentation.count("rows_loaded", len(self.movies))
+        with instrumentation.stage("build_indexes"):
+            if previous is not None:
+                self.build_indexes_from(previous)
+            else:
+                self.build_indexes()
+        if use_cache:
+            with instrumentation.stage("save_cache"):
+                self.save_cache()
+
+    def build_indexes(self):
+        """Build every derived index over the cleaned movies.
+
+        Side effects:
+            Sets the genre attributes, title_index, imdb_scores and the description attributes.
+        """
+        self.build_genre_index(self.movies)
+        self.title_index = TitleIndex(self.movies['title'])
+        self.imdb_scores = self.movies['imdb_score'].to_numpy(dtype=np.float64)
+        self.build_description_vectors(self.movies)
+
+    def build_indexes_from(self, previous):
+        """Build every derived index over the cleaned movies, reusing the description word counts of an older snapshot for the rows whose id and description did not change. The genre and title indexes are rebuilt, unless no row changed at all.
+
+        Args:
+            previous (Database): the older snapshot.
+
+        Side effects:
+            Sets the same attributes as build_indexes, and changes.
+        """
+        #rows are matched by id, keeping the first of any repeated id
+        previous_ids = previous.movies['id'].to_numpy()
+        first = np.flatnonzero(~pd.Series(previous_ids).duplicated().to_numpy())
+        matched = pd.Index(previous_ids[first]).get_indexer(self.movies['id'])
+        matched = np.where(matched >= 0, first[matched], -1)
+        found = matched >= 0
+        old_rows = previous.movies.iloc[matched[found]].reset_index(drop=True)
+        new_rows = self.movies[found].reset_index(drop=True)
+        #missing values count as equal, like DataFrame.equals
+        same = ((old_rows == new_rows) | (old_rows.isna() & new_rows.isna())).all(axis=1).to_numpy()
+        same_description = np.zeros(len(self.movies), dtype=bool)
+        same_description[found] = ((old_rows['description'] == new_rows['description']) | (old_rows['description'].isna() & new_rows['description'].isna())).to_numpy()
+        self.changes = {"added": int((~found).sum()), "changed": int((~same).sum()), "removed": len(previous.movies) - int(found.sum()),
+                        "reused": int(same_description.sum())}
+
+        if previous.movies.equals(self.movies):
+            #nothing changed, so the read-only indexes of the older snapshot are shared as they are
+            for name in self.cached_arrays + self.cached_objects:
+                setattr(self, name, getattr(previous, name))
+            return
+        self.build_genre_index(self.movies)
+        self.title_index = TitleIndex(self.movies['title'])
+        self.imdb_scores = self.movies['imdb_score'].to_numpy(dtype=np.float64)
+        self.build_description_vectors(self.movies, previous, np.where(same_description, matched, -1))
+        instrumentation.count("rows_reused", self.changes["reused"])
+
+    def build_description_vectors(self, df, previous=None, reused=None):
+        """Turn every description into a unit length TF-IDF vector, stored as the arrays of a CSR sparse matrix.
+
+        Args:
+            df (DataFrame): the cleaned movies data.
+            previous (Database): an older snapshot whose word counts are copied instead of tokenizing the description again.
+            reused (ndarray): for every row of df, the row of previous with the same description, or -1 to tokenize it.
+
+        Side effects:
+            Sets description_indptr, description_indices, description_counts, description_data, description_rows, description_features and description_vocabulary.
+        """
+        num_rows = len(df)
+        if previous is None:
+            reused = np.full(num_rows, -1, dtype=np.int64)
+            words = []
+        else:
+            #keep the older feature numbers so its counts can be copied as they are
+            words = list(previous.description_vocabulary)
+        vocabulary = {word: feature for feature, word in enumerate(words)}
+
+        tokenized = np.flatnonzero(reused < 0)
+        lengths = np.zeros(num_rows, dtype=np.int64)
+        indices = []
+        counts = []
+        for row, description in zip(tokenized, df['description'].to_numpy()[tokenized]):
+            terms = {}
+            if isinstance(description, str):
+                for token in TOKEN_PATTERN.findall(description.lower()):
+                    if token not in STOP_WORDS:
+                        feature = vocabulary.get(token)
+                        if feature is None:
+                            feature = vocabulary[token] = len(words)
+                            words.append(token)
+                        terms[feature] = terms.get(feature, 0) + 1
+            indices.extend(terms)
+            counts.extend(terms.values())
+            lengths[row] = len(terms)
+
+        copied = np.flatnonzero(reused >= 0)
+        sources = reused[copied]
+        if previous is not None:
+            lengths[copied] = previous.description_indptr[sources + 1] - previous.description_indptr[sources]
+        self.description_indptr = np.concatenate([[0], np.cumsum(lengths)])
+        self.description_indices = np.empty(self.description_indptr[-1], dtype=np.int32)
+        self.description_counts = np.empty(self.description_indptr[-1], dtype=np.int32)
+        self.description_indices[spread_rows(self.description_indptr, tokenized)] = indices
+        self.description_counts[spread_rows(self.description_indptr, tokenized)] = counts
+        if len(copied):
+            source_positions = spread_rows(previous.description_indptr, sources)
+            self.description_indices[spread_rows(self.description_indptr, copied)] = previous.description_indices[source_positions]
+            self.description_counts[spread_rows(self.description_indptr, copied)] = previous.description_counts[source_positions]
+        self.description_features = len(words)
+        self.description_vocabulary = words
+        self.description_rows = np.repeat(np.arange(num_rows, dtype=np.int32), lengths)
+
+        #sublinear term frequency times smoothed inverse document frequency
+        document_frequency = np.bincount(self.description_indices, minlength=self.description_features)
+        idf = np.log((1 + num_rows) / (1 + document_frequency)) + 1
+        data = (1 + np.log(self.description_counts.astype(np.float64))) * idf[self.description_indices]
+        norms = np.sqrt(np.bincount(self.description_rows, weights=data ** 2, minlength=num_rows))
+        self.description_data = (data / norms[self.description_rows]).astype(np.float32) if len(data) else data.astype(np.float32)
+
+    def description_centroid(self, rows):
+        """Average the description vectors of some rows into a unit length vector.
+
+        Args:
+            rows (list): positions of media within movies.
+
+        Return:
+            ndarray: the dense centroid, with one value per description feature.
+        """
+        centroid = np.zeros(self.description_features, dtype=np.float32)
+        for row in rows:
+            start, end = self.description_indptr[row], self.description_indptr[row + 1]
+            #the features of a single row are distinct, so plain fancy indexing adds them correctly
+            centroid[self.description_indices[start:end]] += self.description_data[start:end]
+        norm = np.linalg.norm(centroid)
+        return centroid / norm if norm > 0 else centroid
+
+    def score_descriptions(self, centroids, rows=None):
+        """Compute the cosine similarity of every description to one or more unit length query vectors with one sparse matrix product.
+
+        Args:
+            centroids (ndarray): a query vector, or a matrix with one query vector per row.
+            rows (ndarray): if given, only the descriptions of these rows of movies are scored.
+
+        Return:
+            ndarray: the similarity of every row of movies (or of every row in rows) to the query, or one column per query vector.
+        """
+        queries = np.atleast_2d(np.asarray(centroids, dtype=np.float32))
+        if rows is None:
+            data, indices, indptr = self.description_data, self.description_indices, self.description_indptr
+        else:
+            #gather the values of the rows into a smaller CSR matrix
+            positions = spread_rows(self.description_indptr, rows)
+            data, indices = self.description_data[positions], self.description_indices[positions]
+            lengths = self.description_indptr[rows + 1] - self.description_indptr[rows]
+            indptr = np.concatenate([[0], np.cumsum(lengths)])
+        products = data[:, None] * queries.T[indices]
+        #a trailing zero row lets rows without any feature (starting at the end) be reduced too
+        products = np.vstack([products, np.zeros((1, len(queries)), dtype=np.float32)])
+        scores = np.add.reduceat(products, indptr[:-1], axis=0)
+        #reduceat gives a row without features the first value of the next row, so reset them
+        scores[indptr[:-1] == indptr[1:]] = 0
+        return scores[:, 0] if np.ndim(centroids) == 1 else scores
+
+    def get_row(self, media):
+        """Find the position of a media within movies.
+
+        Args:
+            media (Movie): the media.
+
+        Return:
+            int: the position of the media, or None if it is not in this database.
+        """
+        if media.database is self:
+            return media.row
+        return self.title_index.lookup(media.title, "exact")
+
+    def find_rows_by_id(self, movie_ids):
+        """Find the positions of media within movies by their ids, which stay the same when a media is retitled.
+
+        Args:
+            movie_ids (list): the ids of the media.
+
+        Return:
+            ndarray: the position of each media, or -1 where the id is not in this database.
+        """
+        if self.id_index is None:
+            ids = pd.Index(self.column("id"))
+            first = np.flatnonzero(~ids.duplicated())
+            self.id_index = (ids[first], first)
+        ids, rows = self.id_index
+        positions = ids.get_indexer(list(movie_ids))
+        return np.where(positions >= 0, rows[positions], -1)
+
+    def get_neighbor_table(self, num_neighbors=20, score_weight=0.0):
+        """Open the precomputed neighbor table of the dataset from the cache directory, building and saving it first if needed.
+
+        Args:
+            num_neighbors (int): the number of neighbors kept per media.
+            score_weight (float): see NeighborTable.build.
+
+        Return:
+            NeighborTable: the neighbor table, memory-mapped when it could be saved.
+        """
+        settings = (num_neighbors, float(score_weight))
+        if settings in self.neighbor_tables:
+            return self.neighbor_tables[settings]
+        if self.source_digest is None:
+            self.source_digest = file_digest(self.filepath)
+        #the file name carries the dataset hash, so a changed dataset never reads an old table
+        path = self.cache_path(f"neighbors.{num_neighbors}.{score_weight:g}.{CACHE_VERSION}.{self.source_digest[:16]}")
+        try:
+            table = NeighborTable.load(path)
+        except (OSError, ValueError):
+            with instrumentation.stage("build_neighbor_table"):
+                table = NeighborTable.build(self, num_neighbors, score_weight)
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                table.save(path, self)
+                table = NeighborTable.load(path)
+            except OSError:
+                pass
+        self.neighbor_tables[settings] = table
+        return table
+
+    def find_similar(self, movie, k=10, score_weight=0.0):
+        """Find the media most like a given media, from the precomputed neighbor table.
+
+        Args:
+            movie (str): the title of the media, found as with find_movie.
+            k (int): the number of similar media to return, at most the number of neighbors in the table.
+            score_weight (float): see NeighborTable.build.
+
+        Return:
+            DataFrame: the similar movies/shows, most similar first, with a similarity column, or None if the title is not in the database.
+        """
+        row = self.title_index.lookup(movie)
+        if row is None:
+            return None
+        neighbors, similarity = self.get_neighbor_table(max(k, 20), score_weight).lookup(row)
+        similar_df = self.movies.iloc[neighbors[:k]].copy()
+        similar_df['similarity'] = similarity[:k]
+        return similar_df
+
+    def cache_path(self, name):
+        """Get the path of one of the files making up the binary cache of the dataset.
+
+        Args:
+            name (str): the name of the cached item, including its extension.
+
+        Return:
+            str: the path of the file within cache_dir.
+        """
+        source = os.path.abspath(self.filepath)
+        key = hashlib.sha1(source.encode()).hexdigest()[:8]
+        return os.path.join(self.cache_dir, f"{os.path.basename(source)}.{key}.{name}")
+
+    def load_cache(self):
+        """Load the cleaned movies and their indexes from the binary cache if it is still valid. The cache is valid when it was written by this CACHE_VERSION and the same pandas and NumPy versions for a dataset with the same size and either the same mtime or the same hash. A cache that cannot be read for any other reason is treated as missing too.
+
+        Return:
+            bool: True if the cache was loaded.
+
+        Side effects:
+            Sets movies and the cached index attributes, and refreshes the cached mtime when only the mtime of the dataset changed.
+        """
+        meta_path = self.cache_path("meta.json")
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            stat = os.stat(self.filepath)
+            if meta["version"] != CACHE_VERSION or meta["size"] != stat.st_size or meta["libraries"] != library_versions():
+                return False
+            if meta["mtime_ns"] != stat.st_mtime_ns:
+                #the file was touched, so only trust the cache if its contents are unchanged
+                if meta["sha256"] != file_digest(self.filepath):
+                    return False
+                meta["mtime_ns"] = stat.st_mtime_ns
+                self.write_cache_file(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+
+            movies = pd.read_pickle(self.cache_path("movies.pkl"))
+            with open(self.cache_path("objects.pkl"), "rb") as f:
+                objects = pickle.load(f)
+            arrays = {name: np.load(self.cache_path(f"{name}.npy"), mmap_mode="r") for name in meta["arrays"]}
+            for name, cls in self.cached_states.items():
+                objects[name] = cls.from_state(objects[name])
+        except Exception:
+            #unpickling a cache written by other library versions can raise nearly anything, so rebuild instead
+            return False
+
+        self.movies = movies
+        self.source_digest = meta["sha256"]
+        for name, value in {**objects, **arrays}.items():
+            setattr(self, name, value)
+        return True
+
+    def save_cache(self):
+        """Write the cleaned movies and their indexes to the binary cache. Failing to write the cache is not an error, the next Database simply rebuilds it.
+
+        Side effects:
+            Writes files to cache_dir.
+        """
+        objects = {name: getattr(self, name) for name in self.cached_objects}
+        for name in self.cached_states:
+            objects[name] = vars(objects[name])
+        arrays = {}
+        for name in self.cached_arrays:
+            value = getattr(self, name)
+            #object arrays cannot be memory-mapped, so they are pickled instead
+            if value.dtype == object:
+                objects[name] = value
+            else:
+                arrays[name] = value
+        try:
+            stat = os.stat(self.filepath)
+            self.source_digest = file_digest(self.filepath)
+            meta = {"version": CACHE_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": self.source_digest, "libraries": library_versions(), "arrays": list(arrays)}
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.write_cache_file(self.cache_path("movies.pkl"), lambda f: self.movies.to_pickle(f))
+            self.write_cache_file(self.cache_path("objects.pkl"), lambda f: pickle.dump(objects, f, protocol=pickle.HIGHEST_PROTOCOL))
+            for name, value in arrays.items():
+                self.write_cache_file(self.cache_path(f"{name}.npy"), lambda f: np.save(f, value))
+            #the metadata is written last so a partially written cache is never considered valid
+            self.write_cache_file(self.cache_path("meta.json"), lambda f: f.write(json.dumps(meta).encode()))
+        except OSError:
+            pass
+
+    def write_cache_file(self, path, write):
+        """Write a cache file atomically by writing to a temporary file and renaming it.
+
+        Args:
+            path (str): the path of the cache file.
+            write (function): writes the contents to the binary file object it is given.
+
+        Side effects:
+            Creates or replaces the file at path.
+        """
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            write(f)
+        os.replace(temp_path, path)
 
     def load_movie_data(self, filepath):
         """Create a Pandas DataFrame using the CSV file containing Netflix shows and movies.
@@ -29,13 +1199,49 @@ class Database():
         Return:
             DataFrame: the movies data as a Pandas DataFrame.
         """
-        #identify the columns to include in the dataframe
-        cols = ["id", "title", "type", "description", "age_certification", "genres", "imdb_score"]
         #load move data from the CSV using Pandas
-        movie_df = pd.read_csv(filepath, usecols=cols)
+        movie_df = pd.read_csv(filepath, usecols=self.columns)
         
         return movie_df
 
+    def stream_movie_data(self, filepath, chunksize):
+        """Load and clean the CSV file in chunks, so that the raw data is never held all at once. The cleaned columns are collected per chunk and joined one column at a time, so besides the cleaned data only one column is ever held twice.
+
+        The CSV parser only shares repeated strings (such as genres or age ratings) within a chunk, so the joined columns share them again, keeping the cleaned data as small as after a single load.
+
+        Args:
+            filepath (str): the filepath to the dataset.
+            chunksize (int): the number of CSV rows read and cleaned at a time.
+
+        Return:
+            DataFrame: the same cleaned movies data as clean_data(load_movie_data(filepath)).
+        """
+        seen_titles = set()
+        index_parts = []
+        column_parts = {}
+        #keep titles as objects even in a chunk where every title is missing
+        for chunk in pd.read_csv(filepath, usecols=self.columns, chunksize=chunksize, dtype={"title": object}):
+            chunk = self.clean_data(chunk)
+            #clean_data only removes duplicates within the chunk, so also drop titles kept by earlier chunks
+            duplicated = np.fromiter((title in seen_titles for title in chunk['title']), dtype=bool, count=len(chunk))
+            chunk = chunk[~duplicated]
+            seen_titles.update(chunk['title'])
+            index_parts.append(chunk.index.to_numpy())
+            for name in chunk.columns:
+                column_parts.setdefault(name, []).append(chunk[name].to_numpy())
+
+        if not index_parts:
+            return self.clean_data(self.load_movie_data(filepath))
+        movies = pd.DataFrame(index=pd.Index(np.concatenate(index_parts)))
+        for name in list(column_parts):
+            #drop the parts of each column as soon as it is joined
+            values = np.concatenate(column_parts.pop(name))
+            if values.dtype == object:
+                codes, uniques = pd.factorize(values, use_na_sentinel=False)
+                values = np.asarray(uniques, dtype=object)[codes]
+            movies[name] = values
+        return movies
+
     def clean_data(self, df):
         """Process the data and get rid of/modify potential insuffiencient rows within the dataframe.
 
@@ -61,26 +1267,249 @@ class Database():
         df_copy = df_copy[~non_english]
         
         return df_copy
+
+    def build_genre_index(self, df):
+        """Parse the genres column once into the compact genre representations used by the hot paths.
+
+        Args:
+            df (DataFrame): the cleaned movies data.
+
+        Side effects:
+            Sets genre_names, genre_codes, genre_sets, genre_set_codes, genre_set_matrix, genre_matrix and genre_masks.
+        """
+        #factorize so every distinct genres string is only parsed once
+        codes, uniques = pd.factorize(df['genres'])
+        #missing genres (code -1) pick up the empty set appended last
+        self.genre_sets = [parse_genres(genres) for genres in uniques] + [[]]
+        self.genre_set_codes = np.where(codes < 0, len(uniques), codes)
+        self.genre_names = sorted({genre for genres in self.genre_sets for genre in genres})
+        self.genre_codes = {genre: i for i, genre in enumerate(self.genre_names)}
+
+        self.genre_set_matrix = np.zeros((len(self.genre_sets), len(self.genre_names)), dtype=np.uint8)
+        unique_masks = np.zeros(len(self.genre_sets), dtype=np.uint64 if len(self.genre_names) <= 64 else object)
+        for row, genres in enumerate(self.genre_sets):
+            self.genre_set_matrix[row, [self.genre_codes[genre] for genre in genres]] = 1
+            unique_masks[row] = sum(1 << self.genre_codes[genre] for genre in set(genres))
+
+        self.genre_matrix = self.genre_set_matrix[self.genre_set_codes]
+        self.genre_masks = unique_masks[self.genre_set_codes]
+
+    def get_genres(self, row):
+        """Get the parsed genres of a media without re-parsing the genres string.
+
+        Args:
+            row (int): the position of the media within movies.
+
+        Return:
+            list: the media's genres in their original order.
+        """
+        return list(self.genre_sets[self.genre_set_codes[row]])
+
+    def has_genre(self, row, genre):
+        """Check whether a media belongs to a genre with a single bit test.
+
+        Args:
+            row (int): the position of the media within movies.
+            genre (str): the name of the genre.
+
+        Return:
+            bool: True if the media has the genre.
+        """
+        code = self.genre_codes.get(genre)
+        if code is None:
+            return False
+        return bool(int(self.genre_masks[row]) >> code & 1)
+
+    def count_genre_matches(self, search_genres):
+        """Count how many of the search genres each media in the database has.
+
+        Args:
+            search_genres (list): the genres to look for.
+
+        Return:
+            ndarray: the number of matching genres for every row of movies.
+        """
+        search_vector = np.zeros(len(self.genre_names), dtype=np.uint8)
+        columns = [self.genre_codes[genre] for genre in search_genres if genre in self.genre_codes]
+        search_vector[columns] = 1
+
+        return self.genre_matrix @ search_vector
+
+    def score_genre_weights(self, weights):
+        """Score each media by the total weight of its genres.
+
+        Args:
+            weights (ndarray): a weight for every genre in genre_names.
+
+        Return:
+            ndarray: the sum of the weights of the genres of every row of movies.
+        """
+        #every distinct genre set is scored once and the scores are then spread to the rows
+        return (self.genre_set_matrix @ np.asarray(weights, dtype=np.float64))[self.genre_set_codes]
+
+    def get_movie(self, row):
+        """Create a Movie object that is a view of a row of the database.
+
+        Args:
+            row (int): the position of the media within movies.
+
+        Return:
+            Movie: the media found at that position.
+        """
+        return Movie.from_row(self, row)
+
+    def column(self, name):
+        """Get a column of movies as a NumPy array, which Movie objects read their values from.
+
+        Args:
+            name (str): the name of the column.
+
+        Return:
+            ndarray: the values of the column.
+        """
+        values = self.column_values.get(name)
+        if values is None:
+            values = self.column_values[name] = self.movies[name].to_numpy()
+        return values
     
-    def find_movie(self, movie):
+    def value_codes(self, name):
+        """Get the distinct values of a column of movies and the code of each row's value, computed once per column.
+
+        Args:
+            name (str): the name of the column.
+
+        Return:
+            tuple: the list of distinct values, with None for missing values, and an array with the position of every row's value in that list.
+        """
+        if name not in self.column_codes:
+            codes, values = pd.factorize(self.movies[name], use_na_sentinel=False)
+            values = [None if isinstance(value, float) and math.isnan(value) else value for value in values]
+            self.column_codes[name] = (values, codes)
+        return self.column_codes[name]
+
+    def filter_rows(self, media_filter):
+        """Get the positions of the media that pass a filter. The positions are cached per filter in filter_cache.
+
+        Args:
+            media_filter (MediaFilter): the filter, or None.
+
+        Return:
+            ndarray: the positions within movies of the media that pass the filter, or None when there is no filter.
+        """
+        if media_filter is None:
+            return None
+        key = media_filter.key()
+        cached = self.filter_cache.get(key)
+        if cached is not None:
+            return cached[0]
+        rows = np.flatnonzero(media_filter.mask(self))
+        self.filter_cache.put(key, (rows,))
+        return rows
+
+    def find_movie(self, movie, mode="substring"):
         """Search for a specific movie within the database.
 
         Args:
             movie (str): the title of the movie.
+            mode (str): how the title is matched, see TitleIndex.lookup. Defaults to the first title containing movie, ignoring case.
 
         Return:
-            a string if a movie was found, or None if the movie name is not in the database.
+            a Movie object if a movie was found, or None if the movie name is not in the database.
         """
-        match = self.movies.loc[self.movies['title'].str.contains(movie, case = False)]
-        if not match.empty:
-            media = Movie(match['id'].iloc[0], match['title'].iloc[0], match['type'].iloc[0], match['description'].iloc[0], match['genres'].iloc[0], match['age_certification'].iloc[0], match['imdb_score'].iloc[0]) 
-            return media
+        with instrumentation.stage("find_movie"):
+            match = self.title_index.lookup(movie, mode)
+        instrumentation.count("title_lookups")
+        if match is not None:
+            return self.get_movie(match)
         else:
             return None
         
+class LiveCatalog():
+    """The current snapshot of a catalog that is refreshed while it is in use.
+
+    A reload builds a new Database beside the current one, reusing the description word counts of rows whose description did not change (the cleaning, genre and title indexes are rebuilt in full), and then swaps it in with a single assignment. Readers take the snapshot once per request from the database attribute and never wait on a lock, so requests started before a swap finish against the older snapshot, which is freed once they are done.
+
+    Attributes:
+        database (Database): the current snapshot.
+        generation (int): the number of snapshots swapped in so far.
+        last_reload (dict): a report on the latest reload, or None.
+        lock (Lock): serializes reloads. Readers never take it.
+        thread (Thread): the latest background reload.
+    """
+    def __init__(self, database):
+        """Initializes a LiveCatalog class.
+
+        Args:
+            database (Database): the first snapshot.
+        """
+        self.database = database
+        self.generation = 0
+        self.last_reload = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def changed(self):
+        """Check whether the dataset file changed since the current snapshot was loaded.
+
+        Return:
+            bool: True if its size or modification time changed.
+        """
+        try:
+            stat = os.stat(self.database.filepath)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) != self.database.source_stat
+
+    def reload(self, filepath=None, force=True):
+        """Build a new snapshot and swap it in.
+
+        Args:
+            filepath (str): the dataset to load. Defaults to the dataset of the current snapshot.
+            force (bool): if False, only reload when the dataset changed.
+
+        Return:
+            dict: the generation, number of rows, seconds taken and changes of the new snapshot (see Database.changes), or None if nothing was reloaded.
+
+        Side effects:
+            Replaces database and clears the recommendations and filters cached on the older snapshot.
+        """
+        with self.lock:
+            previous = self.database
+            if not force and filepath in (None, previous.filepath) and not self.changed():
+                return None
+            start = time.perf_counter()
+            with instrumentation.stage("reload"):
+                database = Database(filepath or previous.filepath, previous.cache_dir, previous=previous)
+            #a single assignment, so every reader sees either the older or the newer snapshot
+            self.database = database
+            self.generation += 1
+            previous.recommendation_cache.clear()
+            previous.filter_cache.clear()
+            instrumentation.count("reloads")
+            self.last_reload = {"generation": self.generation, "rows": len(database.movies), "seconds": time.perf_counter() - start, "changes": database.changes}
+            return self.last_reload
+
+    def reload_in_background(self, filepath=None, force=True):
+        """Start a reload on a daemon thread, unless one is already running.
+
+        Args:
+            filepath (str): see reload.
+            force (bool): see reload.
+
+        Return:
+            Thread: the thread running the reload.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.reload, args=(filepath, force), daemon=True)
+            self.thread.start()
+        return self.thread
+
+
 class Movie():
     """A class for storing information regarding a list of Netflix medias.
 
+    A Movie either holds its own values or is a compact view of a row of a Database, created by from_row, which reads each value from the Database columns only when it is accessed.
+
     Attributes:
         movie_id (str): the media's id.
         title (str): the media's title.
@@ -89,30 +1518,107 @@ class Movie():
         genre (list): the media's list of associated gernes.
         age_ratings (str): the media's age restrictions (if any).
         imdb_score (float): the media's imdb ratings.
+        database (Database): the Database the media is a row of, or None.
+        row (int): the position of the media within the Database, or None.
     """
+    __slots__ = ("database", "row", "values")
+
     def __init__(self, movie_id, title, media_type, movie_desc, genre, age_rating, imdb_score):
         """Initializes a Movie class.
 
         Args:
-            movie_id (str): see class documentation.
-            title (str): see class documentation.
-            media_type (str): see class documentation.
-            movie_desc (str): see class documentation.
-            genre (list): see class documentation.
-            age_rating (str): see class documentation.
-            imdb_score (float): see class documentation.
+            movie_id (str): see class documentation.
+            title (str): see class documentation.
+            media_type (str): see class documentation.
+            movie_desc (str): see class documentation.
+            genre (list or str): see class documentation. A raw genres string is parsed into a list.
+            age_rating (str): see class documentation.
+            imdb_score (float): see class documentation.
+        """
+        #the database hands over genres already parsed, so only raw strings need splitting
+        if isinstance(genre, str):
+            genre = parse_genres(genre)
+        else:
+            genre = list(genre)
+        self.database = None
+        self.row = None
+        self.values = (movie_id, title, media_type, movie_desc, genre, age_rating, imdb_score)
+
+    @classmethod
+    def from_row(cls, database, row):
+        """Create a Movie that reads its values from a row of a Database.
+
+        Args:
+            database (Database): see class documentation.
+            row (int): see class documentation.
+
+        Return:
+            Movie: a view of the row.
+        """
+        media = cls.__new__(cls)
+        media.database = database
+        media.row = int(row)
+        media.values = None
+        return media
+
+    def __reduce__(self):
+        """Pickle the values of the media rather than the Database it is a view of.
+
+        Return:
+            tuple: the class and the arguments that recreate the media.
+        """
+        return (Movie, (self.movie_id, self.title, self.media_type, self.movie_desc, self.genre, self.age_rating, self.imdb_score))
+
+    def get_value(self, index, column):
+        """Get one of the media's values.
+
+        Args:
+            index (int): the position of the value among the arguments of __init__.
+            column (str): the Database column holding the value.
+
+        Return:
+            the value.
         """
-        self.movie_id = movie_id
-        self.title = title
-        self.media_type = media_type
-        self.movie_desc = movie_desc
-        self.genre = []
-        self.age_rating = age_rating
-        self.imdb_score = imdb_score
+        if self.values is not None:
+            return self.values[index]
+        return self.database.column(column)[self.row]
+
+    @property
+    def movie_id(self):
+        """str: the media's id."""
+        return self.get_value(0, "id")
+
+    @property
+    def title(self):
+        """str: the media's title."""
+        return self.get_value(1, "title")
+
+    @property
+    def media_type(self):
+        """str: the type of media (movie or show)."""
+        return self.get_value(2, "type")
 
-        genre_list = genre[1:-1]
-        genre_list = [genre.strip() for genre in genre_list.split(',')]
-        self.genre = [genre.strip("'") for genre in genre_list]
+    @property
+    def movie_desc(self):
+        """str: the description of the media."""
+        return self.get_value(3, "description")
+
+    @property
+    def genre(self):
+        """list: the media's list of associated gernes."""
+        if self.values is not None:
+            return self.values[4]
+        return self.database.get_genres(self.row)
+
+    @property
+    def age_rating(self):
+        """str: the media's age restrictions (if any)."""
+        return self.get_value(5, "age_certification")
+
+    @property
+    def imdb_score(self):
+        """float: the media's imdb ratings."""
+        return self.get_value(6, "imdb_score")
 
     def __str__(self):
         """Returns a string representation of the Movie object.
@@ -124,10 +1630,15 @@ class Movie():
 
 class User():
     """Stores information regarding each users' preferences.
+
+    The preferences should only be changed through add_preference, add_movie and remove_preference, which keep movies and genre_counts up to date.
     
     Attributes:
         name (str): the user's name.
         preferences (list): a list of Movie objects pertaining to a user's favorite shows/movies.
+        movies (dict): the same Movie objects keyed by lowercase title, so looking up or removing a preference by title needs no scan in Python.
+        titles (dict_keys): the lowercase titles of the preferences, a view of movies.
+        genre_counts (dict): the number of preferences in each genre.
     """
     def __init__(self, name):
         """Initializes a User object.
@@ -137,6 +1648,13 @@ class User():
         """
         self.name = name
         self.preferences = []
+        self.movies = {}
+        self.genre_counts = {}
+
+    @property
+    def titles(self):
+        """dict_keys: the lowercase titles of the preferences."""
+        return self.movies.keys()
     
     def add_preference(self, movie, database):
         """Adds a media to the user's list of media preferences.
@@ -148,15 +1666,134 @@ class User():
         Raises:
             ValueError: No media was found withint the database under the name provided.
         """
-        if movie.lower() not in [m.title.lower() for m in self.preferences]:
-            match = database.movies.loc[database.movies['title'].str.contains(movie, case = False)]
-            if not match.empty:
-                media = Movie(match['id'].iloc[0], match['title'].iloc[0], match['type'].iloc[0], match['description'].iloc[0], match['genres'].iloc[0], match['age_certification'].iloc[0], match['imdb_score'].iloc[0])
-                self.preferences.append(media)
+        if movie.lower() not in self.movies:
+            media = database.find_movie(movie)
+            if media is not None:
+                self.add_movie(media)
             
             else:
                 raise ValueError(f"Media with name \"{movie}\" does not exist within the database.")
 
+    def add_movie(self, media):
+        """Adds a Movie object to the user's preferences unless a media with the same title is already there.
+
+        Args:
+            media (Movie): the media to add.
+
+        Return:
+            bool: True if the media was added.
+        """
+        title = media.title.lower()
+        if title in self.movies:
+            return False
+        self.preferences.append(media)
+        self.movies[title] = media
+        for genre in media.genre:
+            self.genre_counts[genre] = self.genre_counts.get(genre, 0) + 1
+        return True
+
+    def rebind(self, database):
+        """Point the preferences at a newer snapshot of the catalog, such as after LiveCatalog.reload, so they show its values and stop holding the older snapshot in memory.
+
+        Args:
+            database (Database): the newer snapshot.
+
+        Return:
+            list: the titles of the preferences that are no longer in the catalog. They are kept as detached copies.
+        """
+        preferences = self.preferences
+        self.preferences = []
+        self.movies = {}
+        self.genre_counts = {}
+        missing = []
+        #match by id, so retitled media are still found and a new media that took an old title is not
+        rows = database.find_rows_by_id([media.movie_id for media in preferences])
+        for media, row in zip(preferences, rows):
+            if row < 0:
+                missing.append(media.title)
+                media = Movie(media.movie_id, media.title, media.media_type, media.movie_desc, media.genre, media.age_rating, media.imdb_score)
+            else:
+                media = database.get_movie(int(row))
+            self.add_movie(media)
+        return missing
+
+    def remove_preference(self, movie):
+        """Removes a media from the user's list of media preferences.
+
+        Args:
+            movie (str): the title of the media, ignoring case.
+
+        Raises:
+            ValueError: the user has no preference with that title.
+        """
+        media = self.movies.pop(movie.lower(), None)
+        if media is None:
+            raise ValueError(f"Media with name \"{movie}\" is not in the preferences of {self.name}.")
+        #Movie has no __eq__, so the list is searched by identity without calling back into Python
+        self.preferences.remove(media)
+        for genre in media.genre:
+            self.genre_counts[genre] -= 1
+            if self.genre_counts[genre] == 0:
+                del self.genre_counts[genre]
+
+def rank_positions(database, matches, k, sort_by="matches", rows=None):
+    """Rank the media that match at least one genre and keep the best k.
+
+    Args:
+        database (Database): a representation of the Database class.
+        matches (ndarray): the number of matching genres, or a genre match score, of every row of the database, or of every row in rows.
+        k (int): the number of recommendations to return.
+        sort_by (str): "matches", "score" or "combined", see Recommender.get_top_k.
+        rows (ndarray): if given, the only positions of the database that are ranked, in the order of matches.
+
+    Return:
+        ndarray: the positions of at most k recommended movies/shows in the database, best first.
+
+    Raises:
+        ValueError: sort_by is not one of the supported orders.
+    """
+    matched = np.flatnonzero(matches > 0)
+    candidates = matched if rows is None else rows[matched]
+    instrumentation.count("rows_scanned", len(matches))
+    instrumentation.count("candidates_ranked", len(candidates))
+    scores = database.imdb_scores[candidates]
+    if sort_by == "matches":
+        keys = matches[matched].astype(np.float64)
+    elif sort_by == "score":
+        keys = scores
+    elif sort_by == "combined":
+        primary = matches[matched]
+        if not np.issubdtype(primary.dtype, np.integer):
+            #match scores are not whole numbers, so replace them by their dense rank first
+            primary = np.unique(primary, return_inverse=True)[1]
+        #scale the matches past the highest score so the score only breaks ties
+        keys = primary * (scores.max(initial=0) + 1) + scores
+    else:
+        raise ValueError(f"Unknown sort order \"{sort_by}\". Expected one of {SORT_ORDERS}.")
+
+    return candidates[top_k_positions(keys, k)]
+
+
+def recommendations_at(database, positions, matches, column="num_matches"):
+    """Build the recommendations DataFrame for ranked positions of the database.
+
+    Args:
+        database (Database): a representation of the Database class.
+        positions (ndarray): the ranked positions of the recommended movies/shows.
+        matches (ndarray): the matches of each ranked position.
+        column (str): the name of the column holding the matches.
+
+    Return:
+        DataFrame: the recommended movies/shows, in the order of positions.
+    """
+    top_df = database.movies.iloc[positions].copy()
+    if np.issubdtype(matches.dtype, np.integer):
+        top_df[column] = matches.astype(np.int64)
+    else:
+        top_df[column] = matches
+    return top_df
+
+
 class Recommender():
     """The main recommendation engine of the system
     
@@ -185,26 +1822,9 @@ class Recommender():
 
         Return:
             dict: a dictionary where the key represents the shared genre between two users and the value represents the amount of matches found for each shared genres.
-
-        Side effects:
-            Modifies the value of self.preferences
         """
-        user_genres = {}
-        friend_genres = {}
-
-        for u in self.user.preferences:
-            for genre in u.genre:
-                if genre in user_genres.keys():
-                    user_genres[genre] += 1
-                else:
-                    user_genres[genre] = 1
-        
-        for f in self.friend.preferences:
-            for genre in f.genre:
-                if genre in friend_genres.keys():
-                    friend_genres[genre] += 1
-                else:
-                    friend_genres[genre] = 1
+        user_genres = self.user.genre_counts
+        friend_genres = self.friend.genre_counts
         
         shared_genres = user_genres.keys() & friend_genres.keys()
         common_genres = {genre: user_genres[genre] + friend_genres[genre] for genre in shared_genres}
@@ -220,25 +1840,87 @@ class Recommender():
         Return:
             DataFrame: the recommended movies/shows.
         """
-        df_copy = database.movies.copy()
         search_genres = list(self.common_genres.keys())
-        print(search_genres)
-        df_copy = df_copy[df_copy['genres'].apply(lambda x: any(genre in x for genre in search_genres))]
-
-        df_copy['num_matches'] = 0
-        for i, row in df_copy.iterrows():
-            # Split the genres string into a list
-            genres_list = row['genres'].strip('][').split(', ')
-            genres_list = [genre.strip("'") for genre in genres_list]
-            # Count the number of matches with the search genres
-            num_matches = sum([genre in search_genres for genre in genres_list])
-            # Update the 'num_matches' column for the current row
-            df_copy.loc[i, 'num_matches'] = num_matches 
-
-        ranked_df = df_copy.sort_values(by = 'num_matches', ascending = False)
+        #the ranking only depends on which genres are shared, so it is cached on that set
+        key = ("recommendation", frozenset(search_genres))
+        cached = database.recommendation_cache.get(key)
+        if cached is not None:
+            return recommendations_at(database, *cached)
+
+        with instrumentation.stage("get_recommendation"):
+            #score every media at once against the multi-hot genre matrix
+            num_matches = database.count_genre_matches(search_genres)
+            matched = num_matches > 0
+            instrumentation.count("rows_scanned", len(num_matches))
+
+            df_copy = database.movies[matched].copy()
+            df_copy['num_matches'] = num_matches[matched].astype(np.int64)
+            instrumentation.count("candidates_ranked", len(df_copy))
+
+            ranked_df = df_copy.sort_values(by = 'num_matches', ascending = False)
+            positions = database.movies.index.get_indexer(ranked_df.index)
+            database.recommendation_cache.put(key, (positions, ranked_df['num_matches'].to_numpy().copy()))
         return ranked_df
        
 
+    def get_top_k(self, database, k, sort_by="matches", media_filter=None):
+        """Get only the best k recommendations, without copying or fully sorting the database.
+
+        Args:
+            database (Database): a representation of the Database class.
+            k (int): the number of recommendations to return.
+            sort_by (str): "matches" to rank by the number of common genres, "score" to rank by IMDb score, or "combined" to rank by the number of common genres and then by IMDb score.
+            media_filter (MediaFilter): if given, only the media passing it are recommended.
+
+        Return:
+            DataFrame: at most k recommended movies/shows with a num_matches column, best first. Ties keep the database order.
+
+        Raises:
+            ValueError: sort_by is not one of the supported orders.
+        """
+        return rank_genre_weights(database, dict.fromkeys(self.common_genres, 1), k, sort_by, media_filter=media_filter)
+
+    def get_content_top_k(self, database, k, media_filter=None):
+        """Get the best k recommendations sharing a common genre, ranked by how similar their descriptions are to those of both users' preferences.
+
+        Args:
+            database (Database): a representation of the Database class.
+            k (int): the number of recommendations to return.
+            media_filter (MediaFilter): if given, only the media passing it are recommended.
+
+        Return:
+            DataFrame: at most k recommended movies/shows with num_matches and similarity columns, best first.
+        """
+        preferences = self.user.preferences + self.friend.preferences
+        return rank_by_content(database, preferences, dict.fromkeys(self.common_genres, 1), k, media_filter)
+
+    def get_neighbor_top_k(self, database, k, num_neighbors=20):
+        """Get the best k recommendations by merging the precomputed neighbors of both users' preferences. A media close to several preferences adds up their similarities.
+
+        Args:
+            database (Database): a representation of the Database class.
+            k (int): the number of recommendations to return.
+            num_neighbors (int): the number of neighbors per preference to merge.
+
+        Return:
+            DataFrame: at most k recommended movies/shows, not already among the preferences, with a similarity column, best first.
+        """
+        table = database.get_neighbor_table(num_neighbors)
+        rows = [row for row in (database.get_row(media) for media in self.user.preferences + self.friend.preferences) if row is not None]
+        neighbor_lists = [table.lookup(row) for row in rows]
+        candidates = np.concatenate([neighbors for neighbors, _ in neighbor_lists] + [np.array([], dtype=np.int32)])
+        weights = np.concatenate([scores for _, scores in neighbor_lists] + [np.array([], dtype=np.float32)])
+
+        positions, inverse = np.unique(candidates, return_inverse=True)
+        similarity = np.bincount(inverse, weights=weights, minlength=len(positions))
+        similarity[np.isin(positions, rows)] = 0
+        top = top_k_positions(similarity, k)
+        top = top[similarity[top] > 0]
+
+        top_df = database.movies.iloc[positions[top]].copy()
+        top_df['similarity'] = similarity[top]
+        return top_df
+
     def sort_by_score(self, df):
         """Sort the recommendations narrowed down by genre by IMDb scores (descending order).
         
@@ -251,6 +1933,199 @@ class Recommender():
         score_df = df.sort_values(by = 'imdb_score', ascending = False)
         return score_df
 
+class GroupRecommender():
+    """Recommendation engine for a group of users, such as a watch party.
+
+    Attributes:
+        users (list): the User objects of the group.
+        database (Database): the Database the group's recommendations come from.
+        policy (str): how the genres of the users are combined. "intersection" searches the genres every user likes, "union" searches the genres any user likes, and "weighted" scores every genre by how much of each user's preferences it covers.
+        genre_counts (ndarray): the number of preferences of each user in each genre, one row per user and one column per genre of the database.
+        genre_weights (ndarray): the weight of each genre in the search for the group.
+    """
+    policies = ("intersection", "union", "weighted")
+
+    def __init__(self, users, database, policy="intersection"):
+        """Initializes a GroupRecommender class.
+
+        Args:
+            users (list): see class documentation.
+            database (Database): see class documentation.
+            policy (str): see class documentation.
+
+        Raises:
+            ValueError: the group has no users or the policy is not supported.
+        """
+        if policy not in self.policies:
+            raise ValueError(f"Unknown group policy \"{policy}\". Expected one of {self.policies}.")
+        if not users:
+            raise ValueError("A group needs at least one user.")
+        self.users = list(users)
+        self.database = database
+        self.policy = policy
+        self.genre_counts = self.get_genre_counts()
+        self.genre_weights = self.get_genre_weights()
+
+    def get_genre_counts(self):
+        """Gather the genre counts every user keeps up to date into one matrix.
+
+        Return:
+            ndarray: the genre counts, one row per user and one column per genre of the database.
+        """
+        counts = np.zeros((len(self.users), len(self.database.genre_names)), dtype=np.int64)
+        for row, user in enumerate(self.users):
+            for genre, count in user.genre_counts.items():
+                if genre in self.database.genre_codes:
+                    counts[row, self.database.genre_codes[genre]] = count
+        return counts
+
+    def get_genre_weights(self):
+        """Combine the genre counts of the users according to the policy.
+
+        Return:
+            ndarray: the weight of each genre. For "intersection" and "union" this is 1 for a searched genre and 0 otherwise.
+        """
+        if self.policy == "intersection":
+            return (self.genre_counts > 0).all(axis=0).astype(np.uint8)
+        elif self.policy == "union":
+            return (self.genre_counts > 0).any(axis=0).astype(np.uint8)
+        #each user's counts are normalized so users with long histories do not outweigh the others
+        totals = self.genre_counts.sum(axis=1, keepdims=True)
+        return (self.genre_counts / np.maximum(totals, 1)).sum(axis=0)
+
+    def get_common_genres(self):
+        """Get the searched genres of the group and their total number of preferences.
+
+        Return:
+            dict: the searched genres mapped to the number of preferences in that genre across the group, from least to most.
+        """
+        totals = self.genre_counts.sum(axis=0)
+        searched = np.flatnonzero(self.genre_weights > 0)
+        common_genres = {self.database.genre_names[code]: int(totals[code]) for code in searched}
+        return dict(sorted(common_genres.items(), key=lambda x: x[1]))
+
+    def get_top_k(self, k, sort_by="matches", media_filter=None):
+        """Score the catalog once for the whole group and get the best k recommendations.
+
+        Args:
+            k (int): the number of recommendations to return.
+            sort_by (str): "matches", "score" or "combined", see Recommender.get_top_k.
+            media_filter (MediaFilter): if given, only the media passing it are recommended.
+
+        Return:
+            DataFrame: at most k recommended movies/shows, best first, with a num_matches column (or a match_score column for the "weighted" policy).
+
+        Raises:
+            ValueError: sort_by is not one of the supported orders.
+        """
+        return rank_genre_weights(self.database, self.get_weights_by_name(), k, sort_by, self.policy == "weighted", media_filter)
+
+    def get_content_top_k(self, k, media_filter=None):
+        """Get the best k recommendations among the searched genres, ranked by how similar their descriptions are to those of the group's preferences.
+
+        Args:
+            k (int): the number of recommendations to return.
+            media_filter (MediaFilter): if given, only the media passing it are recommended.
+
+        Return:
+            DataFrame: at most k recommended movies/shows with num_matches and similarity columns, best first.
+        """
+        preferences = [media for user in self.users for media in user.preferences]
+        return rank_by_content(self.database, preferences, self.get_weights_by_name(), k, media_filter)
+
+    def get_weights_by_name(self):
+        """Get the weights of the searched genres keyed by genre name, which stays meaningful in other processes and for other versions of the database.
+
+        Return:
+            dict: the weight of every genre with a non-zero weight.
+        """
+        searched = np.flatnonzero(self.genre_weights > 0)
+        return {self.database.genre_names[code]: self.genre_weights[code].item() for code in searched}
+
+
+def rank_by_content(database, preferences, genre_weights, k, media_filter=None, any_genre=False):
+    """Rank media by how similar their description is to the descriptions of the preferences, among the media sharing a searched genre.
+
+    Args:
+        database (Database): the Database to recommend from.
+        preferences (list): the Movie objects whose descriptions make up the query.
+        genre_weights (dict): the searched genres, see rank_genre_weights. When none is searched, nothing is recommended.
+        k (int): the number of recommendations to return.
+        media_filter (MediaFilter): if given, only the media passing it are candidates.
+        any_genre (bool): whether every media is a candidate when no genre is searched, instead of none.
+
+    Return:
+        DataFrame: at most k recommended movies/shows, best first, with a num_matches and a similarity column. The preferences themselves are never recommended.
+    """
+    rows = [row for row in (database.get_row(media) for media in preferences) if row is not None]
+    search_vector = np.zeros(len(database.genre_names), dtype=np.uint8)
+    searched = [database.genre_codes[genre] for genre, weight in genre_weights.items() if weight > 0 and genre in database.genre_codes]
+    search_vector[searched] = 1
+    set_matches = database.genre_set_matrix @ search_vector
+
+    #narrow the candidates down before scoring, so filtered requests score fewer descriptions
+    candidates = database.filter_rows(media_filter)
+    if candidates is None:
+        candidates = np.arange(len(database.genre_set_codes))
+    if searched or not any_genre:
+        candidates = candidates[set_matches[database.genre_set_codes[candidates]] > 0]
+    #the preferences are the most similar to themselves, so leave them out
+    candidates = candidates[~np.isin(candidates, rows)]
+
+    with instrumentation.stage("score_descriptions"):
+        similarity = database.score_descriptions(database.description_centroid(rows), candidates)
+    instrumentation.count("rows_scanned", len(candidates))
+
+    top = top_k_positions(similarity, k)
+    positions = candidates[top]
+    top_df = recommendations_at(database, positions, set_matches[database.genre_set_codes[positions]])
+    top_df['similarity'] = similarity[top]
+    return top_df
+
+
+def rank_genre_weights(database, genre_weights, k, sort_by="matches", weighted=False, media_filter=None):
+    """Score the catalog against searched genres and get the best k recommendations.
+
+    Args:
+        database (Database): the Database to recommend from.
+        genre_weights (dict): the weight of each searched genre, keyed by genre name.
+        k (int): the number of recommendations to return.
+        sort_by (str): "matches", "score" or "combined", see Recommender.get_top_k.
+        weighted (bool): whether to rank by the sum of the genre weights instead of the number of searched genres.
+        media_filter (MediaFilter): if given, only the media passing it are scored.
+
+    Return:
+        DataFrame: at most k recommended movies/shows, best first, with a num_matches column (or a match_score column when weighted).
+
+    Raises:
+        ValueError: sort_by is not one of the supported orders.
+    """
+    column = "match_score" if weighted else "num_matches"
+    #only the weights of searched genres matter, so requests sharing them share a cache entry
+    filter_key = media_filter.key() if media_filter is not None else None
+    key = ("top_k", frozenset((genre, weight) for genre, weight in genre_weights.items() if weight > 0), weighted, k, sort_by, filter_key)
+    cached = database.recommendation_cache.get(key)
+    if cached is not None:
+        return recommendations_at(database, *cached, column)
+
+    with instrumentation.stage("rank_genre_weights"):
+        weights = np.zeros(len(database.genre_names), dtype=np.float64)
+        for genre, weight in genre_weights.items():
+            if genre in database.genre_codes:
+                weights[database.genre_codes[genre]] = weight
+        #every distinct genre set is scored once, and only the rows passing the filter look up their score
+        if weighted:
+            set_matches = database.genre_set_matrix @ weights
+        else:
+            set_matches = database.genre_set_matrix @ (weights > 0).astype(np.uint8)
+        rows = database.filter_rows(media_filter)
+        set_codes = database.genre_set_codes if rows is None else database.genre_set_codes[rows]
+        positions = rank_positions(database, set_matches[set_codes], k, sort_by, rows)
+        matches = set_matches[database.genre_set_codes[positions]]
+        database.recommendation_cache.put(key, (positions, matches))
+    return recommendations_at(database, positions, matches, column)
+
+
 def main(filepath):
     """Starts the recommender system.
 
@@ -271,11 +2146,10 @@ def main(filepath):
         while True:
             while True:
                 movie = input("Enter a movie name to add it to this user's preference list: ") #prompt to enter movie name
-                movie_match = database.movies.loc[database.movies['title'].str.contains(re.escape(movie), flags=re.IGNORECASE)] #finds movies in the database that match the movie entered
-                if not movie_match.empty: #if there is a match
+                try:
                     user.add_preference(movie, database) #adds the movie to the user's preference list using the add_preference() method
                     break
-                else:
+                except ValueError: #if there is no match
                     print("Movie not found in database. Please enter another movie") #prints a message if there is not match and prompts the user to try again.
                     
             add_movie = input("Would you like to add another movie? Type \"yes\" or \"no\": ") #asks if they want to add another movie
@@ -318,16 +2192,15 @@ def main(filepath):
                 match = True
         
     recommender = Recommender(first_user, second_user)
-    recommended_movies = recommender.get_recommendation(database)
 
     num = int(input("Select the number of results to display: "))
-    print(recommended_movies.head(num))
+    print(recommender.get_top_k(database, num))
 
     sort = input("Would you like to sort the results by imdb score? Enter 'yes' or 'no': ")
     while sort != 'yes' and sort != 'no':
         sort = input("Please enter 'yes' or 'no': ")
     if sort == 'yes':
-        print(recommender.sort_by_score(recommended_movies).head(num))
+        print(recommender.get_top_k(database, num, sort_by="score"))
 
     response = input("Would you like to see the details of a media? Type 'yes' or 'no': ")
     while response != 'yes' and response != 'no':
@@ -345,6 +2218,367 @@ def main(filepath):
             response = input("Please enter 'yes' or 'no': ")
 
 
+def to_records(top_df):
+    """Convert recommendations to plain records that can be written as JSON.
+
+    Args:
+        top_df (DataFrame): recommendations from get_top_k.
+
+    Return:
+        list: one dict per recommendation, with missing values as None.
+    """
+    columns = [column for column in top_df.columns if column in RESULT_COLUMNS or column in ("num_matches", "match_score", "similarity")]
+    #plain lists are much cheaper than DataFrame.to_dict for the handful of rows of a recommendation
+    rows = zip(*(top_df[column].tolist() for column in columns))
+    return [{column: None if isinstance(value, float) and math.isnan(value) else value for column, value in zip(columns, row)} for row in rows]
+
+
+def create_user(name, titles, database):
+    """Create a User and add their preferences, skipping titles that are not in the database.
+
+    Args:
+        name (str): the user's name.
+        titles (list): the titles of the user's preferences.
+        database (Database): the Database the preferences are looked up in.
+
+    Return:
+        tuple: the User object and the list of titles that were not found.
+    """
+    user = User(name)
+    missing = []
+    for movie in titles:
+        try:
+            user.add_preference(movie, database)
+        except ValueError:
+            missing.append(movie)
+    return user, missing
+
+
+def load_users(filepath, database):
+    """Read users and their preferences from a JSON lines file, with one {"name": ..., "preferences": [...]} object per line.
+
+    Args:
+        filepath (str): the path to the users file.
+        database (Database): the Database the preferences are looked up in.
+
+    Return:
+        dict: the User objects keyed by name.
+
+    Side effects:
+        Prints a warning to stderr for every preference that is not in the database.
+    """
+    users = {}
+    with open(filepath) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            user, missing = create_user(record["name"], record.get("preferences", []), database)
+            for movie in missing:
+                print(f"Skipping preference of {user.name}: \"{movie}\" does not exist within the database.", file=sys.stderr)
+            if user.name in users:
+                for media in user.preferences:
+                    users[user.name].add_movie(media)
+            else:
+                users[user.name] = user
+    return users
+
+
+def read_pairs(filepath):
+    """Lazily read the pairs of user names to recommend for from a CSV file with one pair per row.
+
+    Args:
+        filepath (str): the path to the pairs file.
+
+    Yields:
+        tuple: the names of the user and of their friend.
+    """
+    with open(filepath, newline="") as f:
+        for row in csv.reader(f):
+            if len(row) >= 2:
+                yield row[0].strip(), row[1].strip()
+
+
+def init_batch_worker(filepath, cache_dir, users, instrument=False):
+    """Set up the shared state of a batch worker process. Forked workers inherit the parent's Database, while spawned workers open it from the binary cache.
+
+    Args:
+        filepath (str): the filepath to the dataset.
+        cache_dir (str): the directory of the binary cache of the dataset.
+        users (dict): the User objects keyed by name.
+        instrument (bool): whether the worker keeps metrics, which it hands back to the parent with its results.
+
+    Side effects:
+        Sets the database and users of batch_worker, and starts the worker's instrumentation afresh.
+    """
+    #a forked worker inherits the parent's metrics, which the parent already counts
+    instrumentation.reset()
+    instrumentation.enabled = instrument
+    database = batch_worker.get("database")
+    if database is None or database.filepath != filepath:
+        batch_worker["database"] = Database(filepath, cache_dir)
+    batch_worker["users"] = users
+
+
+def rank_in_worker(genre_weights, k, sort_by="matches", weighted=False, media_filter=None):
+    """Rank recommendations against the Database shared by init_batch_worker, for work offloaded to a process pool. A pool only ever serves the snapshot its workers were started with, so a newer snapshot needs a new pool.
+
+    Args:
+        genre_weights (dict): see rank_genre_weights.
+        k (int): the number of recommendations to return.
+        sort_by (str): see Recommender.get_top_k.
+        weighted (bool): see rank_genre_weights.
+        media_filter (MediaFilter): see rank_genre_weights.
+
+    Return:
+        tuple: the recommendations as records (see to_records), and the worker's metrics for the parent to merge (see Instrumentation.drain).
+    """
+    records = to_records(rank_genre_weights(batch_worker["database"], genre_weights, k, sort_by, weighted, media_filter))
+    return records, instrumentation.drain()
+
+
+def recommend_pairs(pairs, k, sort_by, media_filter=None):
+    """Recommend for a chunk of user pairs using the state set up by init_batch_worker.
+
+    Args:
+        pairs (list): (user, friend) name pairs.
+        k (int): the number of recommendations per pair.
+        sort_by (str): see Recommender.get_top_k, or "content" for Recommender.get_content_top_k.
+        media_filter (MediaFilter): see Recommender.get_top_k.
+
+    Return:
+        list: one JSON encoded result line per pair.
+    """
+    database = batch_worker["database"]
+    users = batch_worker["users"]
+    lines = []
+    for user_name, friend_name in pairs:
+        result = {"user": user_name, "friend": friend_name}
+        missing = [name for name in (user_name, friend_name) if name not in users]
+        if missing:
+            result["error"] = f"Unknown users: {', '.join(missing)}"
+        else:
+            recommender = Recommender(users[user_name], users[friend_name])
+            if sort_by == "content":
+                top_df = recommender.get_content_top_k(database, k, media_filter)
+            else:
+                top_df = recommender.get_top_k(database, k, sort_by, media_filter)
+            result["recommendations"] = to_records(top_df)
+        lines.append(json.dumps(result))
+    return lines
+
+
+def recommend_chunk(task):
+    """Unpack a pool task for recommend_pairs.
+
+    Args:
+        task (tuple): the pairs, k, sort_by and media_filter arguments of recommend_pairs.
+
+    Return:
+        tuple: the lines of recommend_pairs, and the worker's metrics for the parent to merge (see Instrumentation.drain).
+    """
+    return recommend_pairs(*task), instrumentation.drain()
+
+
+def chunk_pairs(pairs, chunksize):
+    """Group pairs into lists so each worker task handles many pairs.
+
+    Args:
+        pairs (iterable): (user, friend) name pairs.
+        chunksize (int): the number of pairs per list.
+
+    Yields:
+        list: up to chunksize pairs.
+    """
+    chunk = []
+    for pair in pairs:
+        chunk.append(pair)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_batch(database, users_path, pairs_path, output, k=10, sort_by="matches", workers=None, chunksize=256, media_filter=None):
+    """Precompute the top recommendations for every user pair of a file across a pool of processes.
+
+    Args:
+        database (Database): the Database to recommend from.
+        users_path (str): the path to the users file, see load_users.
+        pairs_path (str): the path to the pairs file, see read_pairs.
+        output (file): the text file the JSON lines results are written to as they complete.
+        k (int): the number of recommendations per pair.
+        sort_by (str): see Recommender.get_top_k, or "content" for Recommender.get_content_top_k.
+        workers (int): the number of worker processes. Defaults to the number of CPUs, and 1 runs in this process.
+        chunksize (int): the number of pairs handed to a worker at a time.
+        media_filter (MediaFilter): see Recommender.get_top_k.
+
+    Return:
+        int: the number of pairs written.
+
+    Side effects:
+        Writes to output.
+    """
+    if sort_by not in SORT_ORDERS + ("content",):
+        raise ValueError(f"Unknown sort order \"{sort_by}\". Expected one of {SORT_ORDERS + ('content',)}.")
+    users = load_users(users_path, database)
+    workers = workers or os.cpu_count() or 1
+    #set the shared state here first, so forked workers inherit it instead of receiving a pickled copy
+    batch_worker["database"] = database
+    batch_worker["users"] = users
+    chunks = chunk_pairs(read_pairs(pairs_path), chunksize)
+
+    written = 0
+    if workers == 1:
+        results = (recommend_pairs(chunk, k, sort_by, media_filter) for chunk in chunks)
+        for lines in results:
+            output.write("".join(line + "\n" for line in lines))
+            written += len(lines)
+        return written
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+    with context.Pool(workers, initializer=init_batch_worker, initargs=(database.filepath, database.cache_dir, users, instrumentation.enabled)) as pool:
+        tasks = pool.imap(recommend_chunk, ((chunk, k, sort_by, media_filter) for chunk in chunks))
+        for lines, metrics in tasks:
+            instrumentation.merge(metrics)
+            output.write("".join(line + "\n" for line in lines))
+            written += len(lines)
+    return written
+
+
+def handle_request(database, request):
+    """Answer one recommendation request of the JSON mode.
+
+    A request looks like {"users": [{"name": ..., "preferences": [...]}, ...], "k": 10, "sort": "matches", "policy": "intersection"}, where only "users" is required. "filters" such as {"type": "MOVIE", "age_certification": ["PG", "PG-13"], "min_score": 7} restrict the recommendations, see MediaFilter.from_dict. A "content" sort ranks by description similarity, see GroupRecommender.get_content_top_k. An "id" is copied to the result so callers can match results to requests.
+
+    Args:
+        database (Database): the Database to recommend from.
+        request (dict): the decoded request.
+
+    Return:
+        dict: the recommendations and the preferences that were not found, or an error message.
+    """
+    result = {}
+    try:
+        if "id" in request:
+            result["id"] = request["id"]
+        users = []
+        missing = []
+        for record in request["users"]:
+            user, not_found = create_user(record["name"], record.get("preferences", []), database)
+            users.append(user)
+            missing.extend(not_found)
+        #a pair with the intersection policy gives the same results as Recommender
+        group = GroupRecommender(users, database, request.get("policy", "intersection"))
+        media_filter = MediaFilter.from_dict(request.get("filters"))
+        if request.get("sort") == "content":
+            top_df = group.get_content_top_k(int(request.get("k", 10)), media_filter)
+        else:
+            top_df = group.get_top_k(int(request.get("k", 10)), request.get("sort", "matches"), media_filter)
+    except (KeyError, TypeError, ValueError, AttributeError) as error:
+        result["error"] = f"Invalid request: {error}"
+        return result
+
+    result["common_genres"] = group.get_common_genres()
+    result["recommendations"] = to_records(top_df)
+    result["missing"] = missing
+    return result
+
+
+def serve_requests(database, lines, output):
+    """Answer a stream of JSON lines requests, writing one JSON line result per request as soon as it is ready.
+
+    Args:
+        database (Database): the Database to recommend from, loaded once for every request.
+        lines (iterable): the JSON encoded requests, one per line.
+        output (file): the text file results are written to.
+
+    Return:
+        int: the number of requests answered.
+
+    Side effects:
+        Writes to output.
+    """
+    answered = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            result = {"error": f"Invalid JSON: {error}"}
+        else:
+            result = handle_request(database, request) if isinstance(request, dict) else {"error": "Invalid request: expected a JSON object"}
+        output.write(json.dumps(result) + "\n")
+        #flush so a caller driving this process through a pipe gets each answer right away
+        output.flush()
+        answered += 1
+    return answered
+
+
+def run_cli(arguments):
+    """Runs the mode of the recommender system selected by the command line arguments, with the requested instrumentation.
+
+    Args:
+        arguments (Namespace): the arguments from parse_args.
+
+    Side effects:
+        Reads from stdin and prints to stdout, or reads and writes the files named in the arguments. Exports the metrics and writes the profile when asked to.
+    """
+    metrics = arguments.metrics or os.environ.get(METRICS_ENV)
+    if metrics:
+        instrumentation.enabled = True
+    try:
+        with instrumentation.profile(arguments.profile or os.environ.get(PROFILE_ENV) or None, arguments.profile_output):
+            run_mode(arguments)
+    finally:
+        if metrics:
+            instrumentation.export(metrics)
+
+
+def run_mode(arguments):
+    """Runs the mode of the recommender system selected by the command line arguments.
+
+    Args:
+        arguments (Namespace): the arguments from parse_args.
+
+    Side effects:
+        Reads from stdin and prints to stdout, or reads and writes the files named in the arguments.
+    """
+    if arguments.build_neighbors is not None:
+        database = Database(arguments.filepath)
+        table = database.get_neighbor_table(arguments.build_neighbors, arguments.neighbor_score_weight)
+        print(f"Built the {table.neighbors.shape[1]} nearest neighbors of {table.neighbors.shape[0]} media in {database.cache_dir}")
+        return
+    if arguments.pairs is None and arguments.requests is None and arguments.user is None:
+        main(arguments.filepath)
+        return
+
+    database = Database(arguments.filepath)
+    conditions = {"type": arguments.type, "age_certification": arguments.age_certification, "min_score": arguments.min_score}
+    filters = {name: value for name, value in conditions.items() if value is not None}
+    output = sys.stdout if arguments.output == "-" else open(arguments.output, "w")
+    try:
+        if arguments.pairs is not None:
+            run_batch(database, arguments.users, arguments.pairs, output, arguments.k, arguments.sort, arguments.workers, media_filter=MediaFilter.from_dict(filters))
+        elif arguments.requests is not None:
+            if arguments.requests == "-":
+                serve_requests(database, sys.stdin, output)
+            else:
+                with open(arguments.requests) as lines:
+                    serve_requests(database, lines, output)
+        else:
+            request = {"users": [{"name": user[0], "preferences": user[1:]} for user in arguments.user], "k": arguments.k, "sort": arguments.sort, "policy": arguments.policy, "filters": filters}
+            output.write(json.dumps(handle_request(database, request)) + "\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
 def parse_args(arglist):
     """Takes a list of strings from the command prompt and passes them through as arguments
     
@@ -356,9 +2590,31 @@ def parse_args(arglist):
     """
     parser = ArgumentParser()
     parser.add_argument("filepath", type=str, help="path to the CSV file with data about Netflix TV Shows and Movies")
+    parser.add_argument("--users", type=str, help="batch mode: JSON lines file of users and their preferences")
+    parser.add_argument("--pairs", type=str, help="batch mode: CSV file of user pairs to recommend for")
+    parser.add_argument("--workers", type=int, default=None, help="batch mode: number of worker processes (default: number of CPUs)")
+    parser.add_argument("--requests", type=str, help="JSON mode: JSON lines file of recommendation requests, or - for stdin")
+    parser.add_argument("--user", nargs="+", action="append", metavar=("NAME", "TITLE"), help="one-shot mode: a user's name followed by their preferred titles, repeated for each user")
+    parser.add_argument("--policy", type=str, default="intersection", choices=GroupRecommender.policies, help="one-shot mode: how the genres of the users are combined")
+    parser.add_argument("--type", action="append", help="one-shot and batch modes: only recommend media of this type, such as MOVIE or SHOW, repeat to accept several")
+    parser.add_argument("--age-certification", action="append", help="one-shot and batch modes: only recommend media with this age certification, repeat to accept several")
+    parser.add_argument("--min-score", type=float, help="one-shot and batch modes: only recommend media with at least this IMDb score")
+    parser.add_argument("--build-neighbors", type=int, metavar="N", help="offline step: precompute the N most similar media of every media into the cache directory")
+    parser.add_argument("--neighbor-score-weight", type=float, default=0.0, help="share of the neighbor similarity taken from the IMDb score instead of the genres")
+    parser.add_argument("--output", type=str, default="-", help="file to write the JSON lines results to (default: stdout)")
+    parser.add_argument("--metrics", type=str, help=f"turn on the stage timers and counters and export them on exit, to a Prometheus text file if the name ends in .prom and otherwise as a JSON line appended to a log (also ${METRICS_ENV})")
+    parser.add_argument("--profile", type=str, choices=PROFILERS, help=f"profile the run with cProfile or tracemalloc (also ${PROFILE_ENV})")
+    parser.add_argument("--profile-output", type=str, help="file to write the profile to (default: a report on stderr)")
+    parser.add_argument("-k", type=int, default=10, help="number of recommendations per request")
+    parser.add_argument("--sort", type=str, default="matches", choices=SORT_ORDERS + ("content",), help="how recommendations are ranked, where content ranks by description similarity")
 
-    return parser.parse_args(arglist)
+    args = parser.parse_args(arglist)
+    if (args.users is None) != (args.pairs is None):
+        parser.error("--users and --pairs must be given together")
+    if sum(mode is not None for mode in (args.pairs, args.requests, args.user)) > 1:
+        parser.error("--pairs, --requests and --user cannot be combined")
+    return args
 
 if __name__ == "__main__":
     arguments = parse_args(sys.argv[1:])
-    main(arguments.filepath)
\ No newline at end of file
+    run_cli(arguments)
\ No newline at end of file
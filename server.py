@@ -0,0 +1,421 @@
+import sys
+import os
+import json
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs, unquote
+from argparse import ArgumentParser
+from recommender import Database, LiveCatalog, User, GroupRecommender, MediaFilter, SORT_ORDERS, PROFILERS, METRICS_ENV, PROFILE_ENV, TitleIndex, batch_worker, init_batch_worker, rank_in_worker, instrumentation
+
+#the reason phrases of the status codes the service answers with
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class RecommendationServer():
+    """A small HTTP/1.1 JSON service that keeps a Database warm in memory.
+
+    Endpoints:
+        GET /search?q=TITLE&mode=substring: the details of the first matching media.
+        GET /users/NAME: a user's preferences.
+        POST /users/NAME/preferences with {"title": TITLE}: adds a media to a user's preferences.
+        GET /recommendations?users=NAME,NAME&k=10&sort=matches&policy=intersection: the top k recommendations for a group of users, optionally filtered with type=MOVIE,SHOW, age_certification=PG,PG-13 and min_score=7.
+        POST /reload: loads the updated dataset in the background and swaps it in, keeping the users.
+        GET /metrics: the stage timers and counters of the service and its workers in the Prometheus text format, once instrumentation is enabled.
+
+    Attributes:
+        catalog (LiveCatalog): the current snapshot of the Database, which every request takes once and is answered from.
+        users (dict): the User objects created through the service, keyed by name.
+        user_generations (dict): the generation of catalog each user's preferences were last bound to, keyed by name.
+        workers (int): the number of scoring worker processes.
+        executor (ProcessPoolExecutor): the worker processes that score the catalog, so the event loop stays responsive. They are replaced on every swap of the catalog.
+        executor_database (Database): the snapshot the workers of executor were started with, which recommendations are answered from.
+        reload_interval (float): how often, in seconds, the dataset is checked for changes and reloaded, or None to only reload on request.
+    """
+    def __init__(self, database, workers=None, reload_interval=None):
+        """Initializes a RecommendationServer class.
+
+        Args:
+            database (Database): the first snapshot of the catalog.
+            workers (int): the number of scoring worker processes. Defaults to the number of CPUs.
+            reload_interval (float): see class documentation.
+        """
+        self.catalog = LiveCatalog(database)
+        self.reload_interval = reload_interval
+        self.users = {}
+        self.user_generations = {}
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+        self.executor_database = None
+        self.start_workers(database)
+
+    def start_workers(self, database):
+        """Start a new pool of scoring workers for a snapshot. The previous pool finishes the requests it was given against its own snapshot and then exits.
+
+        Args:
+            database (Database): the snapshot the workers score.
+
+        Side effects:
+            Replaces executor and executor_database.
+        """
+        #set the shared Database first, so forked workers inherit it instead of reloading it
+        batch_worker["database"] = database
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        previous = self.executor
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=context, initializer=init_batch_worker, initargs=(database.filepath, database.cache_dir, {}, instrumentation.enabled))
+        self.executor_database = database
+        if previous is not None:
+            previous.shutdown(wait=False)
+
+    async def handle_connection(self, reader, writer):
+        """Answer the HTTP requests of one connection until the client closes it.
+
+        Args:
+            reader (StreamReader): the incoming side of the connection.
+            writer (StreamWriter): the outgoing side of the connection.
+
+        Side effects:
+            Writes responses to the connection.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.respond(writer, 400, {"error": "Malformed request line"})
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    await self.respond(writer, 400, {"error": "Invalid Content-Length"})
+                    break
+                body = await reader.readexactly(length)
+
+                try:
+                    status, payload = await self.route(method, target, body)
+                except Exception as error:
+                    status, payload = 500, {"error": str(error)}
+                await self.respond(writer, status, payload)
+                if version == "HTTP/1.0" or headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload):
+        """Write a JSON response, or a plain text one when the payload is a string.
+
+        Args:
+            writer (StreamWriter): the outgoing side of the connection.
+            status (int): the HTTP status code.
+            payload (dict): the body of the response.
+
+        Side effects:
+            Writes the response to the connection.
+        """
+        if isinstance(payload, str):
+            body, content_type = payload.encode(), "text/plain; version=0.0.4"
+        else:
+            body, content_type = json.dumps(payload).encode(), "application/json"
+        head = f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n"
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def route(self, method, target, body):
+        """Dispatch a request to the endpoint that answers it.
+
+        Args:
+            method (str): the HTTP method.
+            target (str): the request target, including the query string.
+            body (bytes): the request body.
+
+        Return:
+            tuple: the status code and the JSON payload of the response.
+        """
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+
+        if parts == ["search"]:
+            return self.search(method, query)
+        elif len(parts) == 2 and parts[0] == "users":
+            return self.get_user(method, parts[1])
+        elif len(parts) == 3 and parts[0] == "users" and parts[2] == "preferences":
+            return self.add_preference(method, parts[1], body)
+        elif parts == ["recommendations"]:
+            return await self.recommend(method, query)
+        elif parts == ["metrics"]:
+            if method != "GET":
+                return 405, {"error": "Use GET"}
+            return 200, instrumentation.to_prometheus()
+        elif parts == ["reload"]:
+            if method != "POST":
+                return 405, {"error": "Use POST"}
+            return 200, await self.reload(force=True)
+        return 404, {"error": f"No endpoint at {url.path}"}
+
+    def search(self, method, query):
+        """Look up a title.
+
+        Args:
+            method (str): the HTTP method, which must be GET.
+            query (dict): the q parameter holds the title and the optional mode parameter the TitleIndex mode.
+
+        Return:
+            tuple: the status code and the media's details.
+        """
+        if method != "GET":
+            return 405, {"error": "Use GET"}
+        if "q" not in query:
+            return 400, {"error": "Missing the q parameter"}
+        mode = query.get("mode", "substring")
+        if mode not in TitleIndex.modes:
+            return 400, {"error": f"Unknown mode \"{mode}\""}
+        media = self.catalog.database.find_movie(query["q"], mode)
+        if media is None:
+            return 404, {"error": f"Media with name \"{query['q']}\" does not exist within the database."}
+        return 200, movie_to_dict(media)
+
+    def get_user(self, method, name):
+        """Get a user's preferences.
+
+        Args:
+            method (str): the HTTP method, which must be GET.
+            name (str): the user's name.
+
+        Return:
+            tuple: the status code and the user's preferences.
+        """
+        if method != "GET":
+            return 405, {"error": "Use GET"}
+        if name not in self.users:
+            return 404, {"error": f"Unknown user \"{name}\""}
+        return 200, user_to_dict(self.get_bound_user(name))
+
+    def add_preference(self, method, name, body):
+        """Add a media to a user's preferences, creating the user if needed.
+
+        Args:
+            method (str): the HTTP method, which must be POST.
+            name (str): the user's name.
+            body (bytes): a JSON object whose title is the media to add.
+
+        Return:
+            tuple: the status code and the user's preferences.
+        """
+        if method != "POST":
+            return 405, {"error": "Use POST"}
+        try:
+            title = json.loads(body)["title"]
+        except (ValueError, TypeError, KeyError):
+            return 400, {"error": "Expected a JSON body with a title"}
+        generation = self.catalog.generation
+        user = self.get_bound_user(name) if name in self.users else User(name)
+        try:
+            user.add_preference(title, self.catalog.database)
+        except ValueError as error:
+            return 404, {"error": str(error)}
+        self.users[name] = user
+        self.user_generations.setdefault(name, generation)
+        return 200, user_to_dict(user)
+
+    def get_bound_user(self, name):
+        """Get a user, first pointing their preferences at the current snapshot if it was swapped in since they were last used. Rebinding lazily spreads its cost over the users' next requests instead of stalling every request after a reload.
+
+        Args:
+            name (str): the name of a known user.
+
+        Return:
+            User: the user.
+        """
+        user = self.users[name]
+        #read the generation before the snapshot, so a swap in between only causes one more rebind
+        generation = self.catalog.generation
+        if self.user_generations.get(name) != generation:
+            user.rebind(self.catalog.database)
+            self.user_generations[name] = generation
+        return user
+
+    async def recommend(self, method, query):
+        """Recommend for a group of users. The genres are combined here, and the scoring of the catalog runs in the worker pool.
+
+        Args:
+            method (str): the HTTP method, which must be GET.
+            query (dict): users holds the comma separated names, and k, sort, policy and the filters of MediaFilter.from_dict (comma separated) are optional.
+
+        Return:
+            tuple: the status code and the recommendations.
+        """
+        if method != "GET":
+            return 405, {"error": "Use GET"}
+        names = [name for name in query.get("users", "").split(",") if name]
+        unknown = [name for name in names if name not in self.users]
+        if not names or unknown:
+            return 404, {"error": f"Unknown users: {', '.join(unknown)}" if unknown else "Missing the users parameter"}
+        sort_by = query.get("sort", "matches")
+        policy = query.get("policy", "intersection")
+        try:
+            k = int(query.get("k", 10))
+        except ValueError:
+            return 400, {"error": "k must be an integer"}
+        conditions = {name: query[name].split(",") for name in ("type", "age_certification") if name in query}
+        try:
+            if "min_score" in query:
+                conditions["min_score"] = float(query["min_score"])
+        except ValueError:
+            return 400, {"error": "min_score must be a number"}
+        media_filter = MediaFilter.from_dict(conditions)
+        if sort_by not in SORT_ORDERS or policy not in GroupRecommender.policies:
+            return 400, {"error": f"sort must be one of {SORT_ORDERS} and policy one of {GroupRecommender.policies}"}
+
+        #take the snapshot of the workers once, so a reload during the request does not mix two catalogs
+        database, executor = self.executor_database, self.executor
+        group = GroupRecommender([self.get_bound_user(name) for name in names], database, policy)
+        loop = asyncio.get_running_loop()
+        recommendations, metrics = await loop.run_in_executor(executor, rank_in_worker, group.get_weights_by_name(), k, sort_by, policy == "weighted", media_filter)
+        instrumentation.merge(metrics)
+        return 200, {"users": names, "common_genres": group.get_common_genres(), "recommendations": recommendations}
+
+    async def reload(self, force=False):
+        """Reload the catalog on a thread, so requests keep being answered from the current snapshot meanwhile, then point the scoring workers at the new snapshot. The users' preferences follow on their next request, see get_bound_user.
+
+        Args:
+            force (bool): see LiveCatalog.reload.
+
+        Return:
+            dict: the report of LiveCatalog.reload, or {"reloaded": False} if the dataset did not change.
+        """
+        loop = asyncio.get_running_loop()
+        report = await loop.run_in_executor(None, self.catalog.reload, None, force)
+        if report is None:
+            return {"reloaded": False}
+        self.start_workers(self.catalog.database)
+        return {"reloaded": True, **report}
+
+    async def watch_catalog(self):
+        """Reload the catalog whenever the dataset changes, checking every reload_interval seconds. A failed reload, such as of a half-written file, is reported and retried at the next check.
+
+        Side effects:
+            Replaces the snapshot of catalog, and writes failed reloads to stderr.
+        """
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                if self.catalog.changed():
+                    await self.reload()
+            except Exception as error:
+                print(f"Reloading {self.catalog.database.filepath} failed, keeping generation {self.catalog.generation}: {error!r}", file=sys.stderr)
+
+    async def serve(self, host, port, ready=None):
+        """Serve requests until cancelled.
+
+        Args:
+            host (str): the address to listen on.
+            port (int): the port to listen on, or 0 for any free port.
+            ready (Future): if given, set to the port being listened on once the service accepts connections.
+
+        Side effects:
+            Listens for connections and shuts the worker pool down when stopped.
+        """
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        watcher = asyncio.ensure_future(self.watch_catalog()) if self.reload_interval else None
+        try:
+            if ready is not None:
+                ready.set_result(server.sockets[0].getsockname()[1])
+            async with server:
+                await server.serve_forever()
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            self.executor.shutdown(cancel_futures=True)
+
+
+def movie_to_dict(media):
+    """Convert a Movie object to a JSON object.
+
+    Args:
+        media (Movie): the media.
+
+    Return:
+        dict: the media's attributes, with a missing age rating as None.
+    """
+    age_rating = media.age_rating if isinstance(media.age_rating, str) else None
+    return {"id": media.movie_id, "title": media.title, "type": media.media_type, "description": media.movie_desc,
+            "genres": media.genre, "age_certification": age_rating, "imdb_score": float(media.imdb_score)}
+
+
+def user_to_dict(user):
+    """Convert a User object to a JSON object.
+
+    Args:
+        user (User): the user.
+
+    Return:
+        dict: the user's name and the titles of their preferences.
+    """
+    return {"name": user.name, "preferences": [media.title for media in user.preferences]}
+
+
+def parse_args(arglist):
+    """Takes a list of strings from the command prompt and passes them through as arguments
+
+    Args:
+        arglist (list): the list of strings from the command prompt
+
+    Returns:
+        args (ArgumentParser)
+    """
+    parser = ArgumentParser(description="Serve recommendations over HTTP from a warm Database.")
+    parser.add_argument("filepath", type=str, help="path to the CSV file with data about Netflix TV Shows and Movies")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=None, help="number of scoring worker processes (default: number of CPUs)")
+    parser.add_argument("--metrics", type=str, help=f"turn on the stage timers and counters, served at GET /metrics and exported to this file on shutdown (see recommender.py --metrics, also ${METRICS_ENV})")
+    parser.add_argument("--profile", type=str, choices=PROFILERS, help=f"profile the service process with cProfile or tracemalloc until shutdown (also ${PROFILE_ENV})")
+    parser.add_argument("--profile-output", type=str, help="file to write the profile to (default: a report on stderr)")
+    parser.add_argument("--reload-interval", type=float, default=None, help="seconds between checks of the dataset for changes, which are loaded and swapped in without a restart (default: only on POST /reload)")
+    return parser.parse_args(arglist)
+
+def run_server(arguments):
+    """Serve until interrupted, with the requested instrumentation, which is resolved like recommender.run_cli does.
+
+    Args:
+        arguments (Namespace): the arguments from parse_args.
+
+    Side effects:
+        Serves requests, prints the address to stdout, and exports the metrics and writes the profile when asked to.
+    """
+    metrics = arguments.metrics or os.environ.get(METRICS_ENV)
+    if metrics:
+        #enable before the workers are started, so they keep metrics too
+        instrumentation.enabled = True
+    try:
+        with instrumentation.profile(arguments.profile or os.environ.get(PROFILE_ENV) or None, arguments.profile_output):
+            recommendation_server = RecommendationServer(Database(arguments.filepath), arguments.workers, arguments.reload_interval)
+            print(f"Serving on http://{arguments.host}:{arguments.port}")
+            asyncio.run(recommendation_server.serve(arguments.host, arguments.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if metrics:
+            instrumentation.export(metrics)
+
+if __name__ == "__main__":
+    run_server(parse_args(sys.argv[1:]))
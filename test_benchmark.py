@@ -0,0 +1,36 @@
+import copy
+import pandas as pd
+from recommender import Database
+from benchmark import generate_catalog, run_benchmarks, compare_results
+
+def test_generate_catalog(tmp_path):
+    '''Tests that synthetic catalogs keep the shape of titles.csv with unique ids and mostly unique titles.
+    '''
+    filepath = tmp_path / 'catalog.csv'
+    generate_catalog('titles.csv', 1000, filepath)
+    catalog = pd.read_csv(filepath)
+    assert len(catalog) == 1000
+    assert list(catalog.columns) == list(pd.read_csv('titles.csv', nrows=1).columns)
+    assert catalog['id'].is_unique
+    #checks that a share of the titles are duplicates for clean_data to drop
+    duplicates = catalog['title'].dropna().duplicated().sum()
+    assert 0 < duplicates < 100
+    assert len(Database.__new__(Database).clean_data(catalog)) <= len(catalog) - duplicates
+    assert catalog['imdb_score'].dropna().between(1, 10).all()
+
+def test_run_benchmarks(tmp_path):
+    '''Tests that every stage is measured and that regressions past the threshold are reported.
+    '''
+    report = run_benchmarks('titles.csv', [500], tmp_path, repeat=1)
+    stages = report['results']['500']
+    assert {'load_movie_data', 'clean_data', 'init_cached', 'find_movie', 'add_preference', 'get_recommendation'} <= set(stages)
+    assert all(measured['seconds'] > 0 and measured['peak_mb'] >= 0 for measured in stages.values())
+    assert compare_results(report, report) == []
+
+    #a baseline that was twice as fast is a regression, but noise below the floors is not
+    baseline = copy.deepcopy(report)
+    baseline['results']['500']['clean_data']['seconds'] = stages['clean_data']['seconds'] / 2 - 0.01
+    regressions = compare_results(report, baseline, threshold=0.25)
+    assert len(regressions) == 1 and regressions[0].startswith('clean_data on 500 rows: seconds')
+    baseline['results']['500']['clean_data']['seconds'] = stages['clean_data']['seconds'] - 0.0001
+    assert compare_results(report, baseline, threshold=0) == []
@@ -1,6 +1,14 @@
+import io
+import sys
+import time
+import json
+import pickle
+import pathlib
+import subprocess
 import pytest
+import numpy as np
 import pandas as pd
-from recommender import Database, Movie, User
+from recommender import Database, Movie, User, Recommender, GroupRecommender, RecommendationCache, MediaFilter, Instrumentation, LiveCatalog, NeighborTable, rank_by_content, parse_genres, run_batch, serve_requests, parse_args
 
 def test_Database():
     '''Tests the __init__ of the Database class and check if it intializes it.
@@ -131,4 +139,543 @@ def test_User():
     #turns the name attribute in the User object into a string
     str_name = str(user_obj.name)
     #checks to see if the value in the attribute matches
-    assert str_name == 'Megan'
\ No newline at end of file
+    assert str_name == 'Megan'
+
+def test_get_recommendation():
+    '''Tests that recommendations only contain media sharing a common genre and that num_matches is counted correctly.
+    '''
+    database = Database('titles.csv')
+    user = User('Megan')
+    friend = User('Jon')
+    user.add_preference('Arcane', database)
+    friend.add_preference('Taxi Driver', database)
+    recommender = Recommender(user, friend)
+    search_genres = list(recommender.common_genres.keys())
+
+    ranked_df = recommender.get_recommendation(database)
+    #checks that every recommended media has at least one of the common genres
+    assert (ranked_df['num_matches'] > 0).all()
+    #checks that num_matches matches a manual count over the genres string
+    for genres, num_matches in zip(ranked_df['genres'], ranked_df['num_matches']):
+        assert num_matches == sum(genre in search_genres for genre in parse_genres(genres))
+    #checks that the results are sorted by number of matches
+    assert ranked_df['num_matches'].is_monotonic_decreasing
+
+def test_genre_index():
+    '''Tests that genres are parsed once into codes and bitmasks without substring false matches.
+    '''
+    database = Database('titles.csv')
+    row = list(database.movies['title']).index('Taxi Driver')
+    #checks that the parsed genres keep their original order
+    assert database.get_genres(row) == ['drama', 'crime']
+    #checks the bit test for genres the media does and does not have
+    assert database.has_genre(row, 'crime')
+    assert not database.has_genre(row, 'comedy')
+    #checks that partial genre names are not treated as a match
+    assert not database.has_genre(row, 'dram')
+    #checks that every row of the genre matrix agrees with the bitmasks
+    for code in range(len(database.genre_names)):
+        assert ((database.genre_masks.astype('uint64') >> code & 1).astype('uint8') == database.genre_matrix[:, code]).all()
+
+def test_title_index():
+    '''Tests the substring, prefix and exact title search modes of find_movie.
+    '''
+    database = Database('titles.csv')
+    #checks that the default mode keeps the first case-insensitive substring match
+    assert database.find_movie('taxi driv').title == 'Taxi Driver'
+    #checks that the query is treated as plain text rather than a regular expression
+    assert database.find_movie('(') is None or '(' in database.find_movie('(').title
+    #checks that one and two character queries find the first title containing them, as a scan would
+    titles = [title.lower() for title in database.movies['title']]
+    for query in ['a', 'Z', 'ar', 'q.', '7', '\u00e9', '##']:
+        expected = next((title for title in titles if query.lower() in title), None)
+        found = database.find_movie(query)
+        assert (found and found.title.lower()) == expected
+    #checks the prefix and exact modes
+    assert database.find_movie('ARCA', mode='prefix').title == 'Arcane'
+    assert database.find_movie('arcane', mode='exact').title == 'Arcane'
+    assert database.find_movie('arcan', mode='exact') is None
+    #checks that an unknown mode raises an error
+    with pytest.raises(ValueError):
+        database.find_movie('Arcane', mode='fuzzy')
+
+def test_cache(tmp_path):
+    '''Tests that the binary cache reproduces the cleaned data and is rebuilt when the dataset changes.
+    '''
+    filepath = tmp_path / 'titles.csv'
+    filepath.write_bytes(open('titles.csv', 'rb').read())
+    cache_dir = tmp_path / 'cache'
+
+    built = Database(str(filepath), cache_dir=str(cache_dir))
+    cached = Database(str(filepath), cache_dir=str(cache_dir))
+    #checks that the cached data matches the data built from the CSV file
+    assert cached.movies.equals(built.movies)
+    assert (cached.genre_matrix == built.genre_matrix).all()
+    assert cached.find_movie('Arcane').genre == built.find_movie('Arcane').genre
+
+    #checks that the cache is not used once the dataset changes
+    filepath.write_text(open('titles.csv').read().replace('Taxi Driver', 'Taxi Rider'))
+    rebuilt = Database(str(filepath), cache_dir=str(cache_dir))
+    assert rebuilt.find_movie('Taxi Driver') is None
+    assert rebuilt.find_movie('Taxi Rider').title == 'Taxi Rider'
+
+def test_cache_portability(tmp_path):
+    '''Tests that a cache written by the command line is read by importers, and that an unreadable cache is rebuilt instead of raising.
+    '''
+    filepath = tmp_path / 'titles.csv'
+    filepath.write_bytes(open('titles.csv', 'rb').read())
+    subprocess.run([sys.executable, 'recommender.py', str(filepath), '--user', 'Megan', 'Arcane', '--user', 'Jon', 'Taxi Driver'], check=True, capture_output=True)
+    database = Database(str(filepath))
+    #checks that the title index was not pickled as __main__.TitleIndex
+    assert database.load_cache()
+    assert database.find_movie('arcane', 'exact').title == 'Arcane'
+
+    #checks that a cache written by other library versions is a cache miss
+    meta_path = pathlib.Path(database.cache_path('meta.json'))
+    meta = json.loads(meta_path.read_text())
+    meta_path.write_text(json.dumps({**meta, 'libraries': {'pandas': '0.1', 'numpy': '0.1'}}))
+    assert not database.load_cache()
+    #checks that errors raised while unpickling, such as a missing module, are cache misses too
+    meta_path.write_text(json.dumps(meta))
+    objects_path = pathlib.Path(database.cache_path('objects.pkl'))
+    objects_path.write_bytes(b'cno_such_module\nThing\n.')
+    assert not database.load_cache()
+    assert Database(str(filepath)).find_movie('Arcane').title == 'Arcane'
+
+def test_stream_movie_data():
+    '''Tests that loading the dataset in chunks gives the same cleaned data as loading it all at once.
+    '''
+    database = Database('titles.csv', use_cache=False)
+    #uses small chunks so duplicated titles span several chunks
+    streamed = Database('titles.csv', use_cache=False, chunksize=500)
+    pd.testing.assert_frame_equal(streamed.movies, database.movies)
+    assert (streamed.genre_matrix == database.genre_matrix).all()
+
+def test_get_top_k():
+    '''Tests that get_top_k returns the same rows as fully sorting the recommendations.
+    '''
+    database = Database('titles.csv')
+    user = User('Megan')
+    friend = User('Jon')
+    user.add_preference('Arcane', database)
+    user.add_preference('Taxi Driver', database)
+    friend.add_preference('Taxi Driver', database)
+    recommender = Recommender(user, friend)
+    ranked_df = recommender.get_recommendation(database)
+
+    #checks each ranking against a stable full sort of the recommendations
+    top_df = recommender.get_top_k(database, 10)
+    assert list(top_df['id']) == list(ranked_df.sort_index().sort_values(by='num_matches', ascending=False, kind='stable')['id'][:10])
+    top_df = recommender.get_top_k(database, 10, sort_by='score')
+    assert list(top_df['id']) == list(ranked_df.sort_index().sort_values(by='imdb_score', ascending=False, kind='stable')['id'][:10])
+    top_df = recommender.get_top_k(database, 10, sort_by='combined')
+    assert list(top_df['id']) == list(ranked_df.sort_index().sort_values(by=['num_matches', 'imdb_score'], ascending=False, kind='stable')['id'][:10])
+    #checks that asking for more results than there are matches returns every match
+    assert len(recommender.get_top_k(database, len(database.movies))) == len(ranked_df)
+    with pytest.raises(ValueError):
+        recommender.get_top_k(database, 10, sort_by='title')
+
+def test_GroupRecommender():
+    '''Tests the intersection, union and weighted policies of group recommendations.
+    '''
+    database = Database('titles.csv')
+    users = [User('Megan'), User('Jon'), User('Ana')]
+    users[0].add_preference('Arcane', database)
+    users[1].add_preference('Taxi Driver', database)
+    users[2].add_preference('Arcane', database)
+    users[2].add_preference('Taxi Driver', database)
+
+    #checks that a pair with the intersection policy matches the pairwise Recommender
+    group = GroupRecommender(users[:2], database)
+    recommender = Recommender(users[0], users[1])
+    assert group.get_common_genres() == recommender.common_genres
+    assert list(group.get_top_k(10, sort_by='combined')['id']) == list(recommender.get_top_k(database, 10, sort_by='combined')['id'])
+
+    #checks that the union policy searches every genre liked by anyone in the group
+    group = GroupRecommender(users, database, policy='union')
+    assert set(group.get_common_genres()) == {'scifi', 'action', 'drama', 'animation', 'fantasy', 'crime'}
+
+    #checks that the weighted policy ranks by the sum of the genre weights
+    group = GroupRecommender(users, database, policy='weighted')
+    top_df = group.get_top_k(5)
+    assert top_df['match_score'].is_monotonic_decreasing
+    assert top_df['match_score'].iloc[0] == pytest.approx(sum(group.genre_weights[database.genre_codes[genre]] for genre in parse_genres(top_df['genres'].iloc[0])))
+
+    with pytest.raises(ValueError):
+        GroupRecommender(users, database, policy='average')
+
+def test_run_batch(tmp_path):
+    '''Tests that the batch pipeline gives the same results with one process and with a pool of processes.
+    '''
+    database = Database('titles.csv')
+    users_path = tmp_path / 'users.jsonl'
+    users_path.write_text('{"name": "Megan", "preferences": ["Arcane"]}\n{"name": "Jon", "preferences": ["Taxi Driver", "Arcane"]}\n')
+    pairs_path = tmp_path / 'pairs.csv'
+    pairs_path.write_text('Megan,Jon\nJon,Megan\nMegan,Nobody\n' * 5)
+
+    serial = io.StringIO()
+    pooled = io.StringIO()
+    #checks that every pair is written
+    assert run_batch(database, str(users_path), str(pairs_path), serial, k=5, workers=1, chunksize=2) == 15
+    assert run_batch(database, str(users_path), str(pairs_path), pooled, k=5, workers=2, chunksize=2) == 15
+    #checks that the pool writes the same results in the same order
+    assert serial.getvalue() == pooled.getvalue()
+
+    results = [json.loads(line) for line in serial.getvalue().splitlines()]
+    user = User('Megan')
+    friend = User('Jon')
+    user.add_preference('Arcane', database)
+    friend.add_preference('Taxi Driver', database)
+    friend.add_preference('Arcane', database)
+    #checks the results against recommending for the pair directly
+    expected = Recommender(user, friend).get_top_k(database, 5)
+    assert [movie['id'] for movie in results[0]['recommendations']] == list(expected['id'])
+    assert results[2]['error'] == 'Unknown users: Nobody'
+    #checks that the batch pipeline also ranks by description similarity
+    content = io.StringIO()
+    run_batch(database, str(users_path), str(pairs_path), content, k=5, sort_by='content', workers=2, chunksize=2)
+    results = [json.loads(line) for line in content.getvalue().splitlines()]
+    expected = Recommender(user, friend).get_content_top_k(database, 5)
+    assert [movie['id'] for movie in results[0]['recommendations']] == list(expected['id'])
+
+def test_serve_requests():
+    '''Tests that the JSON mode answers every request of a stream with one JSON line.
+    '''
+    database = Database('titles.csv')
+    requests = [
+        json.dumps({'id': 'first', 'users': [{'name': 'Megan', 'preferences': ['Arcane']}, {'name': 'Jon', 'preferences': ['Taxi Driver', 'sdfoinef']}], 'k': 3, 'sort': 'score'}),
+        '',
+        json.dumps({'users': [{'name': 'Megan', 'preferences': ['Arcane']}], 'sort': 'title'}),
+        'not json',
+    ]
+    output = io.StringIO()
+    #checks that blank lines are skipped and every other line gets an answer
+    assert serve_requests(database, requests, output) == 3
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+
+    #checks the answer against the pairwise Recommender
+    user = User('Megan')
+    friend = User('Jon')
+    user.add_preference('Arcane', database)
+    friend.add_preference('Taxi Driver', database)
+    expected = Recommender(user, friend).get_top_k(database, 3, sort_by='score')
+    assert results[0]['id'] == 'first'
+    assert [movie['id'] for movie in results[0]['recommendations']] == list(expected['id'])
+    assert results[0]['missing'] == ['sdfoinef']
+    #checks that invalid requests get an error instead of stopping the stream
+    assert 'error' in results[1]
+    assert 'error' in results[2]
+
+def test_parse_args():
+    '''Tests the command line arguments of the one-shot mode.
+    '''
+    args = parse_args(['titles.csv', '--user', 'Megan', 'Arcane', 'Taxi Driver', '--user', 'Jon', 'Arcane', '-k', '5'])
+    assert args.user == [['Megan', 'Arcane', 'Taxi Driver'], ['Jon', 'Arcane']]
+    assert args.k == 5
+    assert args.sort == 'matches'
+    #checks that a batch needs both a users and a pairs file
+    with pytest.raises(SystemExit):
+        parse_args(['titles.csv', '--pairs', 'pairs.csv'])
+
+def test_RecommendationCache():
+    '''Tests the eviction, expiry and counters of the recommendation cache.
+    '''
+    cache = RecommendationCache(max_bytes=64)
+    cache.put('a', (np.zeros(4, dtype=np.int64),))
+    cache.put('b', (np.zeros(4, dtype=np.int64),))
+    #checks that a hit makes 'a' the most recently used entry, so 'b' is evicted first
+    assert cache.get('a') is not None
+    cache.put('c', (np.zeros(4, dtype=np.int64),))
+    assert cache.get('b') is None
+    assert cache.stats() == {'entries': 2, 'bytes': 64, 'hits': 1, 'misses': 1, 'evictions': 1, 'expirations': 0}
+
+    #checks that entries expire after the ttl
+    cache = RecommendationCache(ttl=0.01)
+    cache.put('a', (np.zeros(1),))
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.expirations == 1
+
+def test_recommendation_cache_hits():
+    '''Tests that repeated recommendations for the same shared genres are answered from the cache with the same results.
+    '''
+    database = Database('titles.csv')
+    user = User('Megan')
+    friend = User('Jon')
+    user.add_preference('Arcane', database)
+    friend.add_preference('Taxi Driver', database)
+    recommender = Recommender(user, friend)
+
+    first = recommender.get_recommendation(database)
+    second = recommender.get_recommendation(database)
+    pd.testing.assert_frame_equal(first, second)
+    top_df = recommender.get_top_k(database, 5, sort_by='combined')
+    pd.testing.assert_frame_equal(recommender.get_top_k(database, 5, sort_by='combined'), top_df)
+    assert database.recommendation_cache.hits == 2
+    assert database.recommendation_cache.misses == 2
+    #checks that a reloaded database does not reuse the results of the old one
+    assert Database('titles.csv').recommendation_cache.stats()['entries'] == 0
+
+def test_user_genre_counts():
+    '''Tests that adding and removing preferences keeps the user's genre counts and titles up to date.
+    '''
+    database = Database('titles.csv')
+    user = User('Megan')
+    user.add_preference('Arcane', database)
+    user.add_preference('Taxi Driver', database)
+    #checks that adding the same media twice, even through another search, is ignored
+    user.add_preference('ARCANE', database)
+    user.add_preference('taxi driv', database)
+    assert len(user.preferences) == 2
+    assert user.genre_counts == {'scifi': 1, 'action': 1, 'drama': 2, 'animation': 1, 'fantasy': 1, 'crime': 1}
+    assert user.titles == {'arcane', 'taxi driver'}
+
+    user.remove_preference('arcane')
+    assert [media.title for media in user.preferences] == ['Taxi Driver']
+    assert user.genre_counts == {'drama': 1, 'crime': 1}
+    #checks that preferences stays the list the titles are kept next to
+    assert user.preferences is user.preferences and list(user.movies.values()) == user.preferences
+    with pytest.raises(ValueError):
+        user.remove_preference('Arcane')
+
+def test_movie_view():
+    '''Tests that movies found in the database are compact views that behave like standalone Movie objects.
+    '''
+    database = Database('titles.csv')
+    media = database.find_movie('Arcane')
+    #checks that the media is a view of a database row without an attribute dictionary
+    assert media.database is database
+    assert not hasattr(media, '__dict__')
+    assert media.movie_desc == database.movies['description'].iloc[media.row]
+    #checks that the view prints the same as a Movie holding the same values
+    copy = Movie(media.movie_id, media.title, media.media_type, media.movie_desc, media.genre, media.age_rating, media.imdb_score)
+    assert str(copy) == str(media)
+    #checks that pickling stores the values instead of the database
+    unpickled = pickle.loads(pickle.dumps(media))
+    assert unpickled.database is None
+    assert str(unpickled) == str(media)
+
+def test_get_content_top_k():
+    '''Tests that content recommendations are ranked by the cosine similarity of the TF-IDF description vectors.
+    '''
+    database = Database('titles.csv')
+    user = User('Megan')
+    friend = User('Jon')
+    user.add_preference('Arcane', database)
+    friend.add_preference('Taxi Driver', database)
+    recommender = Recommender(user, friend)
+
+    top_df = recommender.get_content_top_k(database, 10)
+    assert len(top_df) == 10
+    #checks that the users' own preferences are not recommended back
+    assert not {'Arcane', 'Taxi Driver'} & set(top_df['title'])
+    assert top_df['similarity'].is_monotonic_decreasing
+    #checks that only media sharing a common genre are candidates
+    assert (top_df['num_matches'] > 0).all()
+    #checks the similarity against a dense dot product of the TF-IDF vectors
+    centroid = database.description_centroid([database.get_row(user.preferences[0]), database.get_row(friend.preferences[0])])
+    row = database.get_row(database.find_movie(top_df['title'].iloc[3], mode='exact'))
+    start, end = database.description_indptr[row], database.description_indptr[row + 1]
+    expected = (database.description_data[start:end] * centroid[database.description_indices[start:end]]).sum()
+    assert top_df['similarity'].iloc[3] == pytest.approx(expected, abs=1e-5)
+    #checks that description vectors have unit length
+    assert np.bincount(database.description_rows, weights=database.description_data.astype(float) ** 2)[row] == pytest.approx(1, abs=1e-5)
+    #checks that users without a common genre get no content recommendations, like get_top_k
+    brian = User('Brian')
+    brian.add_preference('Life of Brian', database)
+    assert len(Recommender(user, brian).get_top_k(database, 10)) == 0
+    assert len(Recommender(user, brian).get_content_top_k(database, 10)) == 0
+    #checks that every media is a candidate only when asked for
+    assert len(rank_by_content(database, user.preferences, {}, 10, any_genre=True)) == 10
+    #checks that scoring only some rows gives the same similarities as scoring every row
+    rows = np.array([0, row, len(database.movies) - 1])
+    assert database.score_descriptions(centroid, rows) == pytest.approx(database.score_descriptions(centroid)[rows], abs=1e-6)
+
+def test_NeighborTable(tmp_path):
+    '''Tests that the neighbor table holds the most similar media by genre Jaccard similarity and is read back memory-mapped.
+    '''
+    database = Database('titles.csv', cache_dir=tmp_path)
+    table = database.get_neighbor_table(10)
+    assert isinstance(table.neighbors, np.memmap)
+    #checks a row against a brute force Jaccard similarity, built in small blocks
+    genres = database.genre_matrix.astype(float)
+    row = database.get_row(database.find_movie('Arcane', mode='exact'))
+    shared = genres @ genres[row]
+    jaccard = shared / (genres.sum(axis=1) + genres[row].sum() - shared)
+    jaccard[row] = 0
+    neighbors, similarity = table.lookup(row)
+    assert row not in neighbors
+    assert list(similarity) == pytest.approx(sorted(jaccard, reverse=True)[:10])
+    assert list(similarity) == pytest.approx(list(jaccard[neighbors]))
+    blocked = NeighborTable.build(database, 10, block_sets=7)
+    assert (blocked.neighbors == table.neighbors).all()
+    #checks a blend with the IMDb score against ranking every row, ties going to the better score
+    blended = NeighborTable.build(database, 10, score_weight=0.5)
+    expected = np.where(jaccard > 0, 0.5 * jaccard + 0.5 * database.imdb_scores / 10, -np.inf)
+    expected[row] = -np.inf
+    blended_neighbors, blended_similarity = blended.lookup(row)
+    assert list(blended_similarity) == pytest.approx(sorted(expected, reverse=True)[:10])
+    assert list(blended_similarity) == pytest.approx(list(expected[blended_neighbors]))
+    #checks the "more like this" lookup
+    similar_df = database.find_similar('Arcane', 5)
+    assert list(similar_df['title']) == list(database.movies['title'].iloc[database.get_neighbor_table(20).lookup(row)[0][:5]])
+    assert list(similar_df['similarity']) == pytest.approx(list(similarity[:5]))
+    assert database.find_similar('sdfoinef') is None
+
+    #checks that merged neighbor lists leave out the preferences themselves
+    user = User('Megan')
+    friend = User('Jon')
+    user.add_preference('Arcane', database)
+    friend.add_preference('Taxi Driver', database)
+    top_df = Recommender(user, friend).get_neighbor_top_k(database, 5)
+    assert len(top_df) == 5
+    assert top_df['similarity'].is_monotonic_decreasing
+    assert not {'Arcane', 'Taxi Driver'} & set(top_df['title'])
+
+def test_MediaFilter():
+    '''Tests that filters are applied before ranking, give the same results as filtering the full ranking, and cache their masks.
+    '''
+    database = Database('titles.csv')
+    user = User('Megan')
+    friend = User('Jon')
+    user.add_preference('Arcane', database)
+    friend.add_preference('Taxi Driver', database)
+    recommender = Recommender(user, friend)
+
+    media_filter = MediaFilter(['MOVIE'], ['R', None], 6.5)
+    for sort_by in ('matches', 'score', 'combined'):
+        ranked_df = recommender.get_top_k(database, len(database.movies), sort_by)
+        passing = (ranked_df['type'] == 'MOVIE') & (ranked_df['age_certification'].isin(['R']) | ranked_df['age_certification'].isna()) & (ranked_df['imdb_score'] >= 6.5)
+        top_df = recommender.get_top_k(database, 10, sort_by, media_filter)
+        assert list(top_df['id']) == list(ranked_df[passing]['id'][:10])
+    #checks that the mask is cached per filter combination
+    hits = database.recommendation_cache.hits
+    filter_hits = database.filter_cache.hits
+    rows = database.filter_rows(MediaFilter(['MOVIE'], [None, 'R'], 6.5))
+    assert database.filter_cache.hits == filter_hits + 1
+    #checks that masks are kept apart from the recommendations and their counters
+    assert database.recommendation_cache.hits == hits
+    assert not any(key[0] == 'filter' for key in database.recommendation_cache.entries)
+    movies = database.movies
+    expected = (movies['type'] == 'MOVIE') & (movies['age_certification'].isin(['R']) | movies['age_certification'].isna()) & (movies['imdb_score'] >= 6.5)
+    assert list(rows) == list(np.flatnonzero(expected.to_numpy()))
+    #checks content ranking and the JSON form of the filters
+    content_df = recommender.get_content_top_k(database, 5, MediaFilter.from_dict({'type': 'SHOW', 'min_score': 8}))
+    assert (content_df['type'] == 'SHOW').all() and (content_df['imdb_score'] >= 8).all()
+    assert MediaFilter.from_dict({}) is None
+    with pytest.raises(ValueError):
+        MediaFilter.from_dict({'genre': 'drama'})
+
+def test_Instrumentation(tmp_path, monkeypatch, capsys):
+    '''Tests the stage timers, the counters of the hot paths and the exported metrics.
+    '''
+    disabled = Instrumentation()
+    with disabled.stage('load'):
+        disabled.count('rows_scanned', 10)
+    assert disabled.timings == {} and disabled.counters == {}
+
+    instrumentation = Instrumentation(enabled=True)
+    monkeypatch.setattr('recommender.instrumentation', instrumentation)
+    database = Database('titles.csv', cache_dir=tmp_path, use_cache=False)
+    user = User('Megan')
+    friend = User('Jon')
+    user.add_preference('Arcane', database)
+    friend.add_preference('Taxi Driver', database)
+    recommender = Recommender(user, friend)
+    recommender.get_recommendation(database)
+    recommender.get_recommendation(database)
+    #checks that the recommendation no longer prints its genres
+    assert capsys.readouterr().out == ''
+
+    record = instrumentation.snapshot()
+    assert {'load_movie_data', 'clean_data', 'build_indexes', 'find_movie', 'get_recommendation'} <= set(record['timings'])
+    assert record['timings']['find_movie']['calls'] == 2
+    assert record['counters']['rows_loaded'] == len(database.movies)
+    assert record['counters']['rows_scanned'] == len(database.movies)
+    assert record['counters']['cache_hits'] == 1
+
+    instrumentation.export(str(tmp_path / 'metrics.prom'))
+    text = (tmp_path / 'metrics.prom').read_text()
+    assert 'recommender_stage_calls_total{stage="get_recommendation"} 1\n' in text
+    assert 'recommender_cache_hits_total 1\n' in text
+    instrumentation.export(str(tmp_path / 'metrics.log'))
+    instrumentation.export(str(tmp_path / 'metrics.log'))
+    lines = (tmp_path / 'metrics.log').read_text().splitlines()
+    assert len(lines) == 2 and json.loads(lines[1])['counters'] == record['counters']
+
+    #checks that the metrics of pool workers reach the parent
+    instrumentation.reset()
+    users_path = tmp_path / 'users.jsonl'
+    users_path.write_text('{"name": "Megan", "preferences": ["Arcane"]}\n{"name": "Jon", "preferences": ["Taxi Driver"]}\n')
+    pairs_path = tmp_path / 'pairs.csv'
+    pairs_path.write_text('Megan,Jon\nJon,Megan\n' * 4)
+    run_batch(database, str(users_path), str(pairs_path), io.StringIO(), k=5, workers=2, chunksize=2)
+    record = instrumentation.snapshot()
+    assert record['timings']['rank_genre_weights']['calls'] >= 1
+    assert record['counters']['cache_hits'] + record['counters']['cache_misses'] == 8
+    assert record['counters']['candidates_ranked'] > 0
+
+    with instrumentation.profile('cprofile', str(tmp_path / 'run.prof')):
+        database.find_movie('taxi')
+    assert (tmp_path / 'run.prof').stat().st_size > 0
+    with pytest.raises(ValueError):
+        with instrumentation.profile('perf'):
+            pass
+
+def test_LiveCatalog(tmp_path):
+    '''Tests that a reload applies the changed rows, matches a fresh load and leaves the older snapshot intact for its readers.
+    '''
+    titles = pd.read_csv('titles.csv')
+    filepath = tmp_path / 'titles.csv'
+    titles.to_csv(filepath, index=False)
+    catalog = LiveCatalog(Database(str(filepath), cache_dir=tmp_path / 'cache'))
+    assert not catalog.changed()
+    assert catalog.reload(force=False) is None
+
+    user = User('Megan')
+    friend = User('Jon')
+    user.add_preference('Arcane', catalog.database)
+    friend.add_preference('Taxi Driver', catalog.database)
+    #a reader holding the current snapshot, as an in-flight request would
+    old_database = catalog.database
+    old_df = Recommender(user, friend).get_top_k(old_database, 10, 'score')
+    old_rows = len(old_database.movies)
+
+    #removes a show, rewrites a description and adds a new title
+    updated = titles[titles['title'] != 'Arcane'].copy()
+    updated.loc[updated['title'] == 'Taxi Driver', 'description'] = 'A lonely driver roams the city at night.'
+    updated = pd.concat([updated, titles[titles['title'] == 'Arcane'].assign(id='new1', title='Arcane: Season Two')])
+    updated.to_csv(filepath, index=False)
+    assert catalog.changed()
+    catalog.reload_in_background().join()
+
+    report = catalog.last_reload
+    assert report['generation'] == 1 and report['changes']['added'] == 1 and report['changes']['removed'] == 1
+    assert report['changes']['changed'] == 1
+    assert catalog.database is not old_database
+    #checks that the older snapshot is untouched and its cached recommendations were dropped
+    assert len(old_database.movies) == old_rows
+    assert old_database.find_movie('Arcane', 'exact') is not None
+    assert old_database.recommendation_cache.stats()['entries'] == 0
+    pd.testing.assert_frame_equal(Recommender(user, friend).get_top_k(old_database, 10, 'score'), old_df)
+
+    #checks that the rebuilt snapshot matches a fresh load of the updated dataset
+    fresh = Database(str(filepath), use_cache=False)
+    pd.testing.assert_frame_equal(catalog.database.movies, fresh.movies)
+    assert catalog.database.find_movie('Arcane', 'exact') is None
+    assert (catalog.database.score_descriptions(catalog.database.description_centroid([5, 9])) == fresh.score_descriptions(fresh.description_centroid([5, 9]))).all()
+
+    #checks that preferences move to the new snapshot and removed titles are reported
+    assert user.rebind(catalog.database) == ['Arcane']
+    assert friend.rebind(catalog.database) == []
+    assert friend.preferences[0].database is catalog.database
+    assert friend.preferences[0].movie_desc == 'A lonely driver roams the city at night.'
+    assert user.preferences[0].title == 'Arcane' and user.genre_counts
+
+    #checks that preferences are matched by id, so a retitled media is still found
+    updated.loc[updated['title'] == 'Taxi Driver', 'title'] = 'Taxi Driver (Remastered)'
+    updated.to_csv(filepath, index=False)
+    catalog.reload()
+    assert friend.rebind(catalog.database) == []
+    assert friend.preferences[0].title == 'Taxi Driver (Remastered)'
+    assert friend.titles == {'taxi driver (remastered)'}
@@ -0,0 +1,168 @@
+import asyncio
+import pytest
+import pandas as pd
+from recommender import Database, Instrumentation
+from server import RecommendationServer, parse_args, run_server
+from loadgen import Connection, percentile, run_load
+
+async def exercise_server(database):
+    '''Starts the service on a free port, sends requests to every endpoint and returns the responses.
+    '''
+    recommendation_server = RecommendationServer(database, workers=1)
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    serving = asyncio.ensure_future(recommendation_server.serve('127.0.0.1', 0, ready))
+    port = await ready
+
+    connection = Connection(*await asyncio.open_connection('127.0.0.1', port))
+    responses = {}
+    responses['search'] = await connection.request('GET', '/search?q=arcane&mode=exact')
+    responses['missing'] = await connection.request('GET', '/search?q=sdfoinef')
+    responses['add'] = await connection.request('POST', '/users/Megan/preferences', {'title': 'Arcane'})
+    await connection.request('POST', '/users/Jon/preferences', {'title': 'Taxi Driver'})
+    responses['user'] = await connection.request('GET', '/users/Megan')
+    responses['recommend'] = await connection.request('GET', '/recommendations?users=Megan,Jon&k=3&sort=score')
+    responses['filtered'] = await connection.request('GET', '/recommendations?users=Megan,Jon&k=5&type=SHOW&min_score=8')
+    responses['unknown'] = await connection.request('GET', '/recommendations?users=Megan,Nobody')
+    responses['metrics'] = await metrics_request(connection)
+    executor = recommendation_server.executor
+    responses['reload'] = await connection.request('POST', '/reload')
+    responses['workers_replaced'] = recommendation_server.executor is not executor and recommendation_server.executor_database is recommendation_server.catalog.database
+    responses['after_reload'] = await connection.request('GET', '/recommendations?users=Megan,Jon&k=3&sort=score')
+    connection.close()
+    responses['bad_length'] = await raw_request(port, b'POST /users/Megan/preferences HTTP/1.1\r\nContent-Length: abc\r\n\r\n')
+    responses['load'] = await run_load('127.0.0.1', port, 20, 2, ['/search?q=taxi'])
+
+    serving.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await serving
+    return responses
+
+async def metrics_request(connection):
+    '''Sends a GET /metrics request and returns the status code and the text of the response.
+    '''
+    connection.writer.write(b'GET /metrics HTTP/1.1\r\nHost: test\r\n\r\n')
+    status = int((await connection.reader.readline()).split()[1])
+    length = 0
+    while (line := await connection.reader.readline()) != b'\r\n':
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':')[1])
+    return status, (await connection.reader.readexactly(length)).decode()
+
+async def raw_request(port, request):
+    '''Sends raw bytes on a new connection and returns the status code of the response.
+    '''
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(request)
+    status = int((await reader.readline()).split()[1])
+    writer.close()
+    return status
+
+def test_RecommendationServer(monkeypatch):
+    '''Tests the search, preference, recommendation and metrics endpoints of the HTTP service.
+    '''
+    #the workers get the instrumentation of the service when they start
+    instrumentation = Instrumentation(enabled=True)
+    monkeypatch.setattr('recommender.instrumentation', instrumentation)
+    monkeypatch.setattr('server.instrumentation', instrumentation)
+    database = Database('titles.csv')
+    responses = asyncio.run(exercise_server(database))
+
+    #checks the title search
+    assert responses['search'][0] == 200
+    assert responses['search'][1]['id'] == 'ts222333'
+    assert responses['missing'][0] == 404
+    #checks that preferences are stored per user
+    assert responses['add'] == (200, {'name': 'Megan', 'preferences': ['Arcane']})
+    assert responses['user'] == (200, {'name': 'Megan', 'preferences': ['Arcane']})
+    #checks that recommendations scored in the worker pool are ranked as requested
+    status, payload = responses['recommend']
+    assert status == 200
+    assert payload['common_genres'] == {'drama': 2}
+    scores = [movie['imdb_score'] for movie in payload['recommendations']]
+    assert len(scores) == 3 and scores == sorted(scores, reverse=True)
+    #checks that filters are passed to the worker pool
+    status, payload = responses['filtered']
+    assert status == 200 and len(payload['recommendations']) == 5
+    assert all(movie['type'] == 'SHOW' and movie['imdb_score'] >= 8 for movie in payload['recommendations'])
+    assert responses['unknown'][0] == 404
+    #checks that the metrics include the scoring done in the workers
+    status, text = responses['metrics']
+    assert status == 200
+    assert 'recommender_stage_calls_total{stage="rank_genre_weights"}' in text
+    assert 'recommender_candidates_ranked_total' in text
+    #checks that a reload swaps in a new snapshot and keeps the users
+    status, payload = responses['reload']
+    assert status == 200 and payload['reloaded'] and payload['generation'] == 1
+    assert payload['rows'] == len(database.movies)
+    assert responses['after_reload'] == responses['recommend']
+    #checks that the workers are started afresh from the new snapshot
+    assert responses['workers_replaced']
+    #checks that a malformed Content-Length is answered instead of dropping the connection
+    assert responses['bad_length'] == 400
+    #checks the report of the load generator
+    assert responses['load']['requests'] == 20
+    assert responses['load']['errors'] == 0
+
+async def watch_until_reloaded(recommendation_server, filepath, updated):
+    '''Runs the catalog watcher through a failed reload of a malformed file and then a good reload, and returns the user before and after.
+    '''
+    watcher = asyncio.ensure_future(recommendation_server.watch_catalog())
+    filepath.write_text('garbage\n')
+    await asyncio.sleep(0.5)
+    #the preferences of users are only rebound once they are used
+    updated.to_csv(filepath, index=False)
+    for _ in range(400):
+        if recommendation_server.catalog.generation == 1:
+            break
+        await asyncio.sleep(0.05)
+    watcher.cancel()
+    before = recommendation_server.user_generations['Megan']
+    return before, recommendation_server.get_user('GET', 'Megan')
+
+def test_watch_catalog(tmp_path, capsys):
+    '''Tests that the catalog watcher survives a failed reload and that users are rebound to the new catalog when they are next used.
+    '''
+    titles = pd.read_csv('titles.csv')
+    filepath = tmp_path / 'titles.csv'
+    titles.to_csv(filepath, index=False)
+    recommendation_server = RecommendationServer(Database(str(filepath), cache_dir=tmp_path / 'cache'), workers=1, reload_interval=0.05)
+    recommendation_server.add_preference('POST', 'Megan', b'{"title": "Arcane"}')
+    updated = titles.copy()
+    updated.loc[updated['title'] == 'Arcane', 'title'] = 'Arcane: League of Legends'
+    try:
+        before, user = asyncio.run(watch_until_reloaded(recommendation_server, filepath, updated))
+    finally:
+        recommendation_server.executor.shutdown()
+
+    #checks that the failed reload was reported and the watcher kept going
+    assert 'failed' in capsys.readouterr().err
+    assert recommendation_server.catalog.generation == 1
+    assert before == 0
+    assert user == (200, {'name': 'Megan', 'preferences': ['Arcane: League of Legends']})
+    assert recommendation_server.user_generations['Megan'] == 1
+
+def test_run_server(monkeypatch, tmp_path):
+    '''Tests that the service exports metrics and writes a profile when asked to through the environment, like recommender.py.
+    '''
+    instrumentation = Instrumentation()
+    monkeypatch.setattr('recommender.instrumentation', instrumentation)
+    monkeypatch.setattr('server.instrumentation', instrumentation)
+    async def serve(self, host, port, ready=None):
+        self.executor.shutdown()
+    monkeypatch.setattr(RecommendationServer, 'serve', serve)
+    monkeypatch.setenv('RECOMMENDER_METRICS', str(tmp_path / 'metrics.prom'))
+    monkeypatch.setenv('RECOMMENDER_PROFILE', 'cprofile')
+    run_server(parse_args(['titles.csv', '--workers', '1', '--profile-output', str(tmp_path / 'server.prof')]))
+
+    assert instrumentation.enabled
+    assert 'recommender_stage_calls_total' in (tmp_path / 'metrics.prom').read_text()
+    assert (tmp_path / 'server.prof').stat().st_size > 0
+
+def test_percentile():
+    '''Tests the nearest rank percentile used by the load generator.
+    '''
+    latencies = list(range(1, 101))
+    assert percentile(latencies, 50) == 50
+    assert percentile(latencies, 99) == 99
+    assert percentile([7], 99) == 7